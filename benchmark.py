@@ -0,0 +1,395 @@
+"""
+Reproducible benchmarks for `mytrie.py`.
+
+Builds deterministic synthetic corpora, times trie construction and queries
+against naive baselines built on the built-in `set` and `dict` types, and
+writes the results as JSON so that runs on different commits can be compared:
+
+    $ python benchmark.py -o before.json
+    $ git checkout my-branch
+    $ python benchmark.py -o after.json
+    $ python benchmark.py --compare before.json after.json
+
+`--compare` exits with status 1 if any timing got slower, or any build's peak
+memory grew, by more than the `--threshold` fraction (default 0.10), so it can
+be used to gate changes.
+
+Corpora
+-------
+
+  - `words`: Zipf-distributed natural-language-like tokens built from
+    syllables (keys are `str`).
+  - `urls`: URLs with shared hosts and path segments (keys are `str`).
+  - `ngrams`: word-id n-grams of length 1 to 5 (keys are `StringLike`s of
+    `int`s).
+  - `paths`: deep slash-separated paths of 8 to 24 components (keys are
+    `StringLike`s of `str`s).
+
+Each corpus is generated from a fixed seed, so the same `--seed` and `--scales`
+always produce the same keys.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import timeit
+
+import mytrie
+
+SYLLABLES = ['ka', 'to', 'ri', 'en', 'sa', 'mo', 'lu', 'ing', 'ed', 'pre',
+        'un', 'tion', 'ar', 've', 'st', 'qu', 'ol', 'ne', 'di', 'ch']
+TLDS = ['com', 'org', 'net', 'io', 'de']
+
+#===============================================================================
+# Corpora
+
+def _zipfIndex(rng, n, s=1.1):
+    """
+    Return an index in [0, n) drawn from an approximately Zipfian
+    distribution.
+    """
+    return min(int(n * rng.random() ** (1.0 + 2.0 * s)), n - 1)
+
+def words_corpus(n, seed):
+    rng = random.Random(seed)
+    vocab = []
+    for i in xrange(max(n // 4, 16)):
+        vocab.append(''.join(rng.choice(SYLLABLES)
+            for j in xrange(rng.randint(1, 5))))
+    return [vocab[_zipfIndex(rng, len(vocab))] for i in xrange(n)], ''
+
+def urls_corpus(n, seed):
+    rng = random.Random(seed)
+    hosts = ['%s.%s' % (''.join(rng.choice(SYLLABLES) for j in xrange(3)),
+        rng.choice(TLDS)) for i in xrange(max(n // 50, 4))]
+    segments = [''.join(rng.choice(SYLLABLES) for j in xrange(2))
+            for i in xrange(200)]
+    urls = []
+    for i in xrange(n):
+        path = '/'.join(rng.choice(segments)
+                for j in xrange(rng.randint(0, 4)))
+        urls.append('http://%s/%s?id=%d' % (rng.choice(hosts), path,
+            rng.randint(0, 999)))
+    return urls, ''
+
+def ngrams_corpus(n, seed):
+    rng = random.Random(seed)
+    stream = [_zipfIndex(rng, 5000) for i in xrange(n)]
+    grams = []
+    for i in xrange(n):
+        grams.append(mytrie.StringLike(stream[i:i + rng.randint(1, 5)]))
+    return grams, mytrie.StringLike.Empty
+
+def paths_corpus(n, seed):
+    rng = random.Random(seed)
+    components = ['c%d' % i for i in xrange(64)]
+    paths = []
+    for i in xrange(n):
+        depth = rng.randint(8, 24)
+        paths.append(mytrie.StringLike(components[_zipfIndex(rng, 64)]
+            for j in xrange(depth)))
+    return paths, mytrie.StringLike.Empty
+
+CORPORA = {
+    'words': words_corpus,
+    'urls': urls_corpus,
+    'ngrams': ngrams_corpus,
+    'paths': paths_corpus,
+}
+
+# the collections whose construction is measured
+BUILDS = {
+    'TrieSet': lambda keys, null: mytrie.TrieSet(keys, null_element=null),
+    'set': lambda keys, null: set(keys),
+    'dict': lambda keys, null: dict.fromkeys(keys, 0),
+}
+
+#===============================================================================
+# Naive baselines
+
+def naive_prefixes(string, collection):
+    for i in xrange(len(string) + 1):
+        if string[:i] in collection:
+            yield string[:i]
+
+def naive_maximal_prefix(string, collection):
+    for i in xrange(len(string), -1, -1):
+        if string[:i] in collection:
+            return string[:i]
+    raise KeyError(string)
+
+def naive_extensions(prefix, collection):
+    for string in collection:
+        if string.startswith(prefix):
+            yield string
+
+#===============================================================================
+# Measurement
+
+def best_time(func, repeat, number):
+    """
+    Return the best per-call time of `func` in seconds, out of `repeat` runs of
+    `number` calls each.
+    """
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+def _status_kb(field):
+    """
+    Return a memory figure of this process, in kilobytes, from
+    /proc/self/status (e.g., 'VmRSS' or 'VmHWM'), or None if unavailable.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def measure_build(name, scale, seed, impl):
+    """
+    Return the peak resident set size, in kilobytes, reached while building
+    the `impl` collection of a corpus, above the resident size before the
+    build. The high-water mark is reset first (through /proc/self/clear_refs);
+    where it cannot be, the growth of the resident size while holding the
+    result is returned instead. Returns None where /proc is unavailable.
+    """
+    keys, null = CORPORA[name](scale, seed)
+    gc.collect()
+    before = _status_kb('VmRSS')
+    if before is None:
+        return None
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        field = 'VmHWM'
+    except (IOError, OSError):
+        field = 'VmRSS'
+    result = BUILDS[impl](keys, null)
+    return _status_kb(field) - before
+
+def peak_memory(name, scale, seed, impl):
+    """
+    Return `measure_build` for the given build, run in a freshly spawned
+    interpreter, so that neither the memory high-water mark nor the memory
+    freed by earlier builds carries over; or None if it cannot be measured.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output([sys.executable,
+                os.path.abspath(__file__), '--seed', str(seed),
+                '--measure-build', name, str(scale), impl], stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    output = output.strip()
+    return int(output) if output.isdigit() else None
+
+def queries_for(keys, rng, k):
+    """
+    Return `k` (hit, miss, prefix, string) query tuples drawn from `keys`.
+    """
+    queries = []
+    for i in xrange(k):
+        hit = rng.choice(keys)
+        miss = hit + rng.choice(keys)
+        prefix = hit[:max(1, len(hit) // 3)]
+        queries.append((hit, miss, prefix, miss))
+    return queries
+
+def bench_corpus(name, scale, seed, repeat):
+    keys, null = CORPORA[name](scale, seed)
+    rng = random.Random(seed + 1)
+    queries = queries_for(keys, rng, 200)
+    ext_queries = queries[:10]
+    results = []
+
+    def record(op, impl, seconds, calls=1, **extra):
+        row = {'corpus': name, 'scale': scale, 'op': op, 'impl': impl,
+                'seconds': seconds, 'per_call_us': seconds * 1e6 / calls}
+        row.update(extra)
+        results.append(row)
+
+    # construction
+    for impl in ('TrieSet', 'set', 'dict'):
+        build = lambda: BUILDS[impl](keys, null)
+        record('build', impl, best_time(build, repeat, 1),
+                peak_kb=peak_memory(name, scale, seed, impl))
+
+    trie = BUILDS['TrieSet'](keys, null)
+    baseline = BUILDS['set'](keys, null)
+    half = len(keys) // 2
+    trie_a = mytrie.TrieSet(keys[:half], null_element=null)
+    trie_b = mytrie.TrieSet(keys[half // 2:], null_element=null)
+    set_a, set_b = set(keys[:half]), set(keys[half // 2:])
+
+    def contains(collection):
+        def run():
+            for hit, miss, prefix, string in queries:
+                hit in collection
+                miss in collection
+        return run
+
+    def prefixes(collection, gen):
+        def run():
+            for hit, miss, prefix, string in queries:
+                list(gen(string, collection))
+        return run
+
+    def maximal_prefix(collection, func):
+        def run():
+            for hit, miss, prefix, string in queries:
+                func(string, collection)
+        return run
+
+    def extensions(collection, gen):
+        def run():
+            for hit, miss, prefix, string in ext_queries:
+                list(gen(prefix, collection))
+        return run
+
+    n_q = len(queries)
+    cases = [
+        ('contains', 'TrieSet', contains(trie), 2 * n_q),
+        ('contains', 'set', contains(baseline), 2 * n_q),
+        ('prefixes', 'TrieSet', prefixes(trie,
+            lambda s, c: c.prefixes(s)), n_q),
+        ('prefixes', 'set', prefixes(baseline, naive_prefixes), n_q),
+        ('maximal_prefix', 'TrieSet', maximal_prefix(trie,
+            lambda s, c: c.maximal_prefix(s)), n_q),
+        ('maximal_prefix', 'set', maximal_prefix(baseline,
+            naive_maximal_prefix), n_q),
+        ('extensions', 'TrieSet', extensions(trie,
+            lambda p, c: c.extensions(p)), len(ext_queries)),
+        ('extensions', 'set', extensions(baseline, naive_extensions),
+            len(ext_queries)),
+        ('union', 'TrieSet', lambda: trie_a | trie_b, 1),
+        ('union', 'set', lambda: set_a | set_b, 1),
+        ('intersection', 'TrieSet', lambda: trie_a & trie_b, 1),
+        ('intersection', 'set', lambda: set_a & set_b, 1),
+    ]
+    for op, impl, func, calls in cases:
+        record(op, impl, best_time(func, repeat, 1), calls)
+
+    return results
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                    stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(corpora, scales, seed, repeat):
+    results = []
+    for name in corpora:
+        for scale in scales:
+            sys.stderr.write('%s @ %d...\n' % (name, scale))
+            results.extend(bench_corpus(name, scale, seed, repeat))
+    return {
+        'meta': {
+            'mytrie_version': mytrie.__version__,
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': seed,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+#===============================================================================
+# Comparison
+
+# measurements compared by --compare; a larger value is a regression
+METRICS = ('seconds', 'peak_kb')
+
+def compare(old, new, threshold):
+    """
+    Return a list of (key, old_value, new_value, ratio) for the measurements
+    (see METRICS) present in both result sets, keyed by (corpus, scale, op,
+    impl, metric), and whether any of them regressed by more than `threshold`.
+    """
+    def index(report):
+        values = {}
+        for r in report['results']:
+            for metric in METRICS:
+                if r.get(metric) is not None:
+                    values[(r['corpus'], r['scale'], r['op'], r['impl'],
+                        metric)] = r[metric]
+        return values
+
+    old_values, new_values = index(old), index(new)
+    rows = []
+    regressed = False
+    for key in sorted(set(old_values) & set(new_values)):
+        ratio = float(new_values[key]) / old_values[key] \
+                if old_values[key] else 1.0
+        rows.append((key, old_values[key], new_values[key], ratio))
+        if ratio > 1.0 + threshold:
+            regressed = True
+    return rows, regressed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--corpora', default=','.join(sorted(CORPORA)),
+            help='comma-separated corpora to run (default: all)')
+    parser.add_argument('--scales', default='1000,10000,100000',
+            help='comma-separated numbers of keys per corpus')
+    parser.add_argument('--seed', type=int, default=2011)
+    parser.add_argument('--repeat', type=int, default=3,
+            help='take the best of this many timing runs')
+    parser.add_argument('-o', '--output',
+            help='write JSON results here instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+            help='compare two JSON result files instead of running')
+    parser.add_argument('--threshold', type=float, default=0.10,
+            help='relative slowdown or memory growth reported as a '\
+                    'regression')
+    # used by peak_memory to measure a single build in a fresh interpreter
+    parser.add_argument('--measure-build', nargs=3,
+            metavar=('CORPUS', 'SCALE', 'IMPL'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure_build:
+        name, scale, impl = args.measure_build
+        print measure_build(name, int(scale), args.seed, impl)
+        return 0
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        rows, regressed = compare(old, new, args.threshold)
+        for (corpus, scale, op, impl, metric), v_old, v_new, ratio in rows:
+            flag = '  REGRESSED' if ratio > 1.0 + args.threshold else ''
+            print '%-7s %8d %-15s %-8s %-7s %12.6f %12.6f %6.2fx%s' % (corpus,
+                    scale, op, impl, metric, v_old, v_new, ratio, flag)
+        return 1 if regressed else 0
+
+    corpora = [c for c in args.corpora.split(',') if c]
+    for name in corpora:
+        if name not in CORPORA:
+            parser.error('unknown corpus %r' % name)
+    scales = [int(s) for s in args.scales.split(',') if s]
+    report = run(corpora, scales, args.seed, args.repeat)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        json.dump(report, out, indent=1, sort_keys=True)
+        out.write('\n')
+    finally:
+        if args.output:
+            out.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
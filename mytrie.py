@@ -36,6 +36,15 @@ from string-like objects to arbitrary values. Neither class has any notion of an
 ordering on the string-like objects; ordered tries may be included in a future
 version of this module.
 
+For key sets too large to build in memory, `PackedTrieSet.build` sorts keys in
+bounded memory, spilling to temporary files, and writes a compact read-only
+trie file, which `PackedTrieSet` queries through a memory mapping.
+`TrieJournal` persists a trie incrementally, logging each modification and
+replaying the log on top of the last checkpoint when reopened. `BitTrie` does
+longest-prefix matching of integers, e.g., IP addresses, against bit prefixes.
+`BoundedTrieDict` is a TrieDict of bounded size that evicts keys by LRU or LFU,
+for use as a cache.
+
 String-like types
 -----------------
 
@@ -91,37 +100,23 @@ Performance
 -----------
 
 For large collections of strings, the trie classes can be quite a bit faster at
-finding prefix/suffix relationships than naive methods using built-in types. For
-example, let's create a module `test.py` like so:
-
-```python
-import mytrie
-
-# 565 kiloword novel
-corpus = open('war_and_peace.txt', 'r').read()
-tokens = corpus.split()
-
-s = set(tokens)
-ts = mytrie.TrieSet(tokens)
+finding prefix/suffix relationships than naive methods using built-in types,
+though they are slower to build and to test for membership.
 
-def naive_extensions(prefix, collection):
-    for string in collection:
-        if string.startswith(prefix):
-            yield string
-```
+The script `benchmark.py`, distributed alongside this module, measures this on
+deterministic synthetic corpora (natural-language tokens, URLs, integer n-grams
+and deep paths) at several scales. It times construction, peak memory,
+`__contains__`, `prefixes`, `maximal_prefix`, `extensions` and set algebra
+against naive `set` and `dict` baselines, and writes JSON results that can be
+compared across commits to catch regressions:
 
-A comparison of the naive generator of string extensions to
-`TrieSet.extensions`, using both to create a list of words that start with
-`'t'`:
+    $ python benchmark.py --scales 1000,10000,100000 -o before.json
+    $ python benchmark.py --scales 1000,10000,100000 -o after.json
+    $ python benchmark.py --compare before.json after.json
 
-    $ python -m timeit -s "import test" "list(test.naive_extensions('t', test.s))"
-    100 loops, best of 3: 12.8 msec per loop
-
-    $ python -m timeit -s "import test" "list(test.ts.extensions('t'))"
-    100 loops, best of 3: 6.64 msec per loop
-
-So `TrieSet.extensions` is about twice as fast, and the difference gets larger
-the more strings there are.
+As a rule of thumb, `TrieSet.extensions` beats a linear scan of a `set` by a
+factor that grows with the number of keys, while `__contains__` is several times
+slower than a hash lookup.
 
 
 END MODULE DOC
@@ -129,9 +124,22 @@ END MODULE DOC
 
 __version__ = "0.1.0"
 
-# TODO: Packing
-
+import array
+import bisect
+import collections
+import contextlib
+import copy
+import cPickle
+import gc
+import heapq
+import itertools
+import mmap
 import operator
+import os
+import struct
+import sys
+import tempfile
+import zlib
 
 def isStringLike(obj, nullObj):
     """
@@ -310,7 +318,20 @@ class TrieBase(object):
       - implement some method for adding keys; see `TrieSet.add()` for an
         example.
     """
-    def __init__(self, null_element):
+
+    # public methods whose calls are counted by instrument(), those among
+    # them which return a single key, and those which return a list of keys
+    # (or of tuples beginning with keys). subclasses may extend these.
+    _instrumentedMethods = ('__contains__', '__iter__', 'has_extension_of',
+            'successors', 'suffixes', 'maximal_suffix', 'extensions',
+            'maximal_extension', 'prefixes', 'maximal_prefix', 'ends_with',
+            'count_ending_with', 'maximal_key_suffix_of', 'next_distribution',
+            'hamming_search')
+    _keyReturningMethods = ('maximal_suffix', 'maximal_extension',
+            'maximal_prefix', 'maximal_key_suffix_of')
+    _keyListReturningMethods = ('hamming_search',)
+
+    def __init__(self, null_element, reverse_index=False):
         self._null_element = null_element
 
         if not isStringLike(null_element, null_element):
@@ -325,6 +346,17 @@ class TrieBase(object):
         # [suffixes, is_member]
         self._root = [{}, False]
 
+        # optional mirror trie of reversed keys, for suffix-of-key queries.
+        # its nodes are [predecessors, is_member, n_keys_in_subtree], and it
+        # is kept up to date by subclasses calling _addReversed() whenever a
+        # key becomes a member.
+        self._reverse = [{}, False, 0] if reverse_index else None
+
+        # set by freeze(); frozen tries refuse to be modified
+        self._frozen = False
+
+        # the TrieJournal recording modifications, if any
+        self._journal = None
 
     def __contains__(self, key):
         cur_node = self._root
@@ -353,6 +385,79 @@ class TrieBase(object):
                 cur_node = new_node
         return cur_node
 
+    def _addReversed(self, key):
+        """
+        Record a newly added key in the reverse index, if there is one.
+        Subclasses must call this exactly once per key, when it first becomes a
+        member.
+        """
+        if self._reverse is None:
+            return
+        cur_node = self._reverse
+        cur_node[2] += 1
+        for el in reversed(list(key)):
+            try:
+                cur_node = cur_node[0][el]
+            except KeyError:
+                new_node = [{}, False, 0]
+                cur_node[0][el] = new_node
+                cur_node = new_node
+            cur_node[2] += 1
+        cur_node[1] = True
+
+    def _removeReversed(self, key):
+        """
+        Remove a key that has ceased to be a member from the reverse index, if
+        there is one, pruning nodes that no longer lead to any key.
+        """
+        if self._reverse is None:
+            return
+        cur_node = self._reverse
+        cur_node[2] -= 1
+        for el in reversed(list(key)):
+            el_node = cur_node[0][el]
+            el_node[2] -= 1
+            if not el_node[2]:
+                del cur_node[0][el]
+                return
+            cur_node = el_node
+        cur_node[1] = False
+
+    def _reverseNodeOf(self, suffix):
+        if self._reverse is None:
+            raise ValueError('Suffix queries need a reverse index; construct '\
+                    'the trie with reverse_index=True.')
+        cur_node = self._reverse
+        for el in reversed(list(suffix)):
+            try:
+                cur_node = cur_node[0][el]
+            except KeyError:
+                return None
+        return cur_node
+
+    def _reversePathTo(self, string):
+        """
+        Generate the nodes of the reverse index along the path of the reversed
+        string, starting at its root, for as long as the path exists.
+        """
+        cur_node = self._reverseNodeOf(self._null_element)
+        yield cur_node
+        for el in reversed(list(string)):
+            try:
+                cur_node = cur_node[0][el]
+            except KeyError:
+                return
+            yield cur_node
+
+    def _generateReversedKeys(self, start_node, suffix):
+        stack = [(start_node, suffix)]
+        while stack:
+            cur_node, key = stack.pop()
+            if cur_node[1]:
+                yield key
+            for el, el_node in cur_node[0].iteritems():
+                stack.append((el_node, el+key))
+
     def _nodeOf(self, key):
         cur_node = self._root
         for el in key:
@@ -362,12 +467,101 @@ class TrieBase(object):
                 return None
         return cur_node
 
+    def freeze(self):
+        """
+        Make the trie immutable: afterwards, attempts to add, set or remove
+        keys raise a TypeError. Freezing cannot be undone, but a frozen trie
+        can be copied into a new, unfrozen one.
+        """
+        self._frozen = True
+
+    def _checkMutable(self):
+        if self._frozen:
+            raise TypeError('%s is frozen.' % type(self).__name__)
+
+    def _removeKey(self, key):
+        """
+        Make a contained key no longer a member, and prune the nodes that then
+        lead to no key. Return the number of nodes pruned. Raise a KeyError if
+        the key is not contained. Subclasses' removal methods should call this.
+        """
+        self._checkMutable()
+        # (node, symbol) pairs along the path to key
+        path = []
+        cur_node = self._root
+        for el in key:
+            try:
+                el_node = cur_node[0][el]
+            except KeyError:
+                raise KeyError(key)
+            path.append((cur_node, el))
+            cur_node = el_node
+        if not cur_node[1]:
+            raise KeyError(key)
+
+        self._releaseNode(cur_node)
+        cur_node[1] = False
+        pruned = 0
+        while path and not (cur_node[1] or cur_node[0]):
+            parent, el = path.pop()
+            del parent[0][el]
+            cur_node = parent
+            pruned += 1
+        self._removeReversed(key)
+        return pruned
+
+    def _releaseNode(self, node):
+        """
+        Discard any extra data of a member node whose key is being removed.
+        """
+        del node[2:]
+
     def has_extension_of(self, prefix):
         """
         Return True if the given string-like is a prefix of any contained key.
         """
         return self._nodeOf(prefix) is not None
 
+    def view(self, prefix):
+        """
+        Return a read-only `TrieView` of the keys that begin with the given
+        prefix, relative to it. The view is anchored at the prefix's node, so
+        the prefix is walked once, rather than once per query. Raise a KeyError
+        if the prefix is not a prefix of any contained element.
+
+        >>> t = TrieSet(['user1/a', 'user1/ab', 'user1/b', 'user2/a'])
+        >>> v = t.view('user1/')
+        >>> sorted(v), len(v), 'ab' in v, 'user1/ab' in v
+        (['a', 'ab', 'b'], 3, True, False)
+        >>> sorted(v.view('a'))
+        ['', 'b']
+        """
+        node = self._nodeOf(prefix)
+        if node is None:
+            raise KeyError('%r is not a prefix of any contained element.' %\
+                    prefix)
+        return TrieView(self, prefix, node)
+
+    def _valueOf(self, node):
+        """
+        Return the value of a member node, for tries that map keys to values.
+        """
+        raise TypeError('%s has no values.' % type(self).__name__)
+
+    def _applyLogged(self, op, args):
+        """
+        Redo a modification recorded by a TrieJournal.
+        """
+        if op == 'a':
+            self.add(*args)
+        elif op == 's':
+            self[args[0]] = args[1]
+        elif op == 'd':
+            if isinstance(self, TrieSet):
+                self.remove(*args)
+            else:
+                del self[args[0]]
+
     def __pathTo(self, key):
         cur_node = self._root
         for el in key:
@@ -418,6 +612,200 @@ class TrieBase(object):
 
         return n
 
+    # whether member nodes hold a value at node[2] that must be serialized
+    _hasValues = False
+
+    def __reduce__(self):
+        """
+        Tries pickle to a flat, compact preorder encoding of their nodes
+        rather than to nested lists of dicts, so that pickling, copying and
+        sending them to other processes neither recurses once per trie level
+        (and so works on keys of any length) nor costs much more than a flat
+        list of the same size. The cyclic garbage collector is paused while
+        the nodes, and the values of a TrieDict, are rebuilt, so a TrieDict
+        loads about as fast as a TrieSet of the same shape: about 2 seconds
+        each for 122,800 keys in 930,000 nodes, on the machine they were
+        timed on.
+
+        >>> import cPickle
+        >>> t = TrieSet(['abc', 'aac', 'adc', 'adce'], reverse_index=True)
+        >>> u = cPickle.loads(cPickle.dumps(t, 2))
+        >>> u == t, sorted(u.ends_with('c'))
+        (True, ['aac', 'abc', 'adc'])
+
+        >>> d = TrieDict([('a', [1]), ('ab', [2]), ('b', None)])
+        >>> cPickle.loads(cPickle.dumps(d)).items() == d.items()
+        True
+
+        >>> deep = TrieSet(['x' * 20000, 'x' * 10000])
+        >>> deep2 = cPickle.loads(cPickle.dumps(deep, 2))
+        >>> len(deep2), 'x' * 10000 in deep2, 'x' * 15000 in deep2
+        (2, True, False)
+
+        Minimized tries keep their shared nodes:
+        >>> m = TrieSet(['walked', 'talked', 'balked'])
+        >>> m.minimize()
+        >>> m2 = cPickle.loads(cPickle.dumps(m, 2))
+        >>> m2.stats()['nodes'], m.stats()['nodes'], m2 == m
+        (7, 7, True)
+        """
+        cls = getattr(self, '_uninstrumentedClass', type(self))
+        return (_newTrie, (cls,), self.__getstate__())
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # instrumentation is not carried over
+        for name in ('_counters', '_idleCounters', '_callTotals', '_hook'):
+            state.pop(name, None)
+        # nor is the journal, nor the indexes of hamming_search
+        state['_journal'] = None
+        state.pop('_hammingCache', None)
+        # the reverse index is rebuilt from the keys
+        state['_reverse'] = state['_reverse'] is not None
+        state['_root'] = self._flatten()
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        flat = state.pop('_root')
+        reverse_index = state.pop('_reverse')
+        self.__dict__.update(state)
+        self._reverse = [{}, False, 0] if reverse_index else None
+        self._root = self._unflatten(flat)
+        if reverse_index:
+            for key in self._iterKeys():
+                self._addReversed(key)
+
+    def __copy__(self):
+        """
+        Return a new trie of the same class with the same keys (and, for a
+        TrieDict, the same value objects), sharing no nodes with this one.
+
+        >>> import copy
+        >>> d = TrieDict([('a', [1])])
+        >>> c = copy.copy(d)
+        >>> c['b'] = [2]
+        >>> 'b' in d, c['a'] is d['a']
+        (False, True)
+
+        >>> c = copy.deepcopy(d)
+        >>> c['a'].append(3)
+        >>> d['a'], c['a']
+        ([1], [1, 3])
+        """
+        copied = _newTrie(getattr(self, '_uninstrumentedClass', type(self)))
+        copied.__setstate__(self.__getstate__())
+        return copied
+
+    def __deepcopy__(self, memo):
+        state = self.__getstate__()
+        symbols, shape, values = state['_root']
+        state['_root'] = (symbols, shape, copy.deepcopy(values, memo))
+        copied = _newTrie(getattr(self, '_uninstrumentedClass', type(self)))
+        memo[id(self)] = copied
+        copied.__setstate__(state)
+        return copied
+
+    def _nodeValues(self, nodes):
+        """
+        Return a list of the values of the given member nodes, for
+        serialization.
+        """
+        return [node[2] for node in nodes]
+
+    def _setNodeValues(self, nodes, values):
+        for node, value in itertools.izip(nodes, values):
+            node.append(value)
+
+    def _flatten(self):
+        """
+        Encode the nodes of the trie in preorder as a tuple (symbols, shape,
+        values): the symbol leading to each non-root node; a packed array of
+        one integer per node, `(n_children << 2) | (is_member << 1)`, or
+        `(index << 1) | 1` for a node shared with the index'th distinct node in
+        preorder (not counting these references); and the values of member
+        nodes, if any. Symbols of `str` tries are joined into a single string.
+        """
+        symbols = []
+        shape = []
+        members = []
+        # shared nodes only exist in frozen (e.g., minimized) tries
+        seen = {} if self._frozen else None
+        n_nodes = 0
+        stack = [(None, self._root)]
+        with _gcPaused():
+            while stack:
+                el, node = stack.pop()
+                if el is not None:
+                    symbols.append(el)
+                if seen is not None:
+                    if id(node) in seen:
+                        shape.append((seen[id(node)] << 1) | 1)
+                        continue
+                    seen[id(node)] = n_nodes
+                n_nodes += 1
+                children = node[0]
+                shape.append((len(children) << 2) | (bool(node[1]) << 1))
+                if node[1]:
+                    members.append(node)
+                stack.extend(children.iteritems())
+        if isinstance(self._null_element, str):
+            symbols = ''.join(symbols)
+        values = self._nodeValues(members) if self._hasValues else None
+        return (symbols, _packInts(shape), values)
+
+    def _unflatten(self, flat):
+        symbols, shape, values = flat
+        shape = _unpackInts(shape)
+        members = []
+        # all nodes in preorder, if any may be shared
+        nodes = [] if self._frozen else None
+
+        root = [{}, bool(shape[0] & 2)]
+        if root[1]:
+            members.append(root)
+        if nodes is not None:
+            nodes.append(root)
+        # children dicts of the nodes still awaiting children, and how many
+        stack = [root[0]]
+        remaining = [shape[0] >> 2]
+        with _gcPaused():
+            for el, entry in itertools.izip(symbols, itertools.islice(shape,
+                    1, None)):
+                while not remaining[-1]:
+                    stack.pop()
+                    remaining.pop()
+                remaining[-1] -= 1
+                if entry & 1:
+                    stack[-1][el] = nodes[entry >> 1]
+                    continue
+                node = stack[-1][el] = [{}, bool(entry & 2)]
+                if entry & 2:
+                    members.append(node)
+                if nodes is not None:
+                    nodes.append(node)
+                if entry >> 2:
+                    stack.append(node[0])
+                    remaining.append(entry >> 2)
+
+            # still paused: the new nodes are not yet tracked as old
+            if values is not None:
+                self._setNodeValues(members, values)
+        return root
+
+    def _iterKeys(self):
+        """
+        Generate the contained keys, like __iter__, but using an explicit
+        stack, so that keys of any length can be handled.
+        """
+        stack = [(self._root, self._null_element)]
+        while stack:
+            node, key = stack.pop()
+            if node[1]:
+                yield key
+            for el, el_node in node[0].iteritems():
+                stack.append((el_node, key+el))
+
     def successors(self, prefix):
         """
         Generate (in arbitrary order) those prefixes of contained keys that
@@ -529,6 +917,211 @@ class TrieBase(object):
         except KeyError:
             pass
 
+    def next_distribution(self, context, backoff=True, weight=None):
+        """
+        Return a pair `(used, distribution)`, where `distribution` maps each
+        symbol that follows the prefix `used` in some contained key to a
+        weight, found in a single visit to the prefix's successors:
+            - if `weight` is `'count'` (the default for tries without values),
+              the number of keys that begin with `used` plus the symbol. Only
+              frozen TrieSets (and their views), which keep the size of every
+              subtree, support counts; other tries raise a ValueError.
+            - if `weight` is `'value'` (the default for TrieDicts), the value
+              of the key `used` plus the symbol, for those successors that are
+              keys.
+
+        `used` is the context itself, unless it has no successors and
+        `backoff` is True: then it is the longest suffix of the context that
+        has some. Raise a KeyError if there is none, or, without `backoff`, if
+        the context is not a prefix of any contained element.
+
+        With n-gram counts, this gives the next-token distribution of an n-gram
+        language model with backoff:
+
+        >>> lm = TrieDict()
+        >>> lm.count_ngrams('abracadabra', 3)
+        >>> lm.next_distribution('br')
+        ('br', {'a': 2})
+        >>> lm.next_distribution('zab')
+        ('ab', {'r': 2})
+        >>> sorted(lm.next_distribution('a')[1].items())
+        [('b', 2), ('c', 1), ('d', 1)]
+
+        >>> words = TrieSet(['car', 'cart', 'cat', 'dog'])
+        >>> words.next_distribution('ca')
+        Traceback (most recent call last):
+            ...
+        ValueError: Count weights are only defined for frozen TrieSets; call freeze() first.
+        >>> words.freeze()
+        >>> sorted(words.next_distribution('ca')[1].items())
+        [('r', 2), ('t', 1)]
+        >>> words.next_distribution('cart')
+        ('', {'c': 3, 'd': 1})
+        >>> words.next_distribution('cow', backoff=False)
+        Traceback (most recent call last):
+            ...
+        KeyError: "'cow' is not a prefix of any contained element."
+
+        Either weight takes time proportional to the length of the context
+        (times the number of suffixes tried) plus the number of successors,
+        once a frozen TrieSet has sized its subtrees on first use.
+        """
+        if weight is None:
+            weight = 'value' if self._hasValues else 'count'
+        if weight not in ('count', 'value'):
+            raise ValueError("weight must be 'count' or 'value' (got %r)" %\
+                    (weight,))
+        if weight == 'count':
+            # raises unless subtree sizes are kept
+            self._subtreeCount(self._root)
+
+        used = context
+        while True:
+            node = self._nodeOf(used)
+            if node is not None and (node[0] or not backoff):
+                break
+            if not backoff:
+                raise KeyError('%r is not a prefix of any contained element.' %\
+                        used)
+            if not used:
+                raise KeyError('No suffix of %r is a proper prefix of any '\
+                        'contained element.' % (context,))
+            used = used[1:]
+
+        distribution = {}
+        if weight == 'count':
+            for el, el_node in node[0].iteritems():
+                distribution[el] = self._subtreeCount(el_node)
+        else:
+            for el, el_node in node[0].iteritems():
+                if el_node[1]:
+                    distribution[el] = self._valueOf(el_node)
+        return used, distribution
+
+    def hamming_search(self, query, max_mismatches, segments=None):
+        """
+        Return a list of pairs `(key, mismatches)` of the contained keys of the
+        same length as the query that differ from it in at most
+        `max_mismatches` positions, by fewest mismatches, then by key.
+
+        The search walks the trie with a budget of mismatches, following only
+        the child matching the query once the budget is spent, so it visits
+        far fewer nodes than a scan of the keys does.
+
+        >>> barcodes = TrieSet(['ACGT', 'ACGA', 'TCGA', 'GGGG', 'ACG'])
+        >>> barcodes.hamming_search('ACGT', 1)
+        [('ACGT', 0), ('ACGA', 1)]
+        >>> barcodes.hamming_search('TCGT', 2)
+        [('ACGT', 1), ('TCGA', 1), ('ACGA', 2)]
+
+        Under `instrument()`, each match counts as a key:
+
+        >>> barcodes.instrument()
+        >>> barcodes.hamming_search('ACGT', 1)
+        [('ACGT', 0), ('ACGA', 1)]
+        >>> sorted(barcodes.call_counts()['hamming_search'].items())
+        [('calls', 1), ('keys', 2), ('nodes', 10), ('probes', 4)]
+        >>> barcodes.uninstrument()
+
+        For larger budgets, a frozen trie can split queries into `segments`
+        contiguous segments and search one index per segment: a trie of the
+        keys rotated to begin with that segment. Every match has at most
+        `max_mismatches // segments` mismatches in some segment (by the
+        pigeonhole principle), and the search of each index enforces that
+        tighter budget on its first segment, pruning near the root. The
+        indexes of each query length are built on first use and kept.
+
+        >>> barcodes.hamming_search('TCGT', 2, segments=3)
+        Traceback (most recent call last):
+            ...
+        ValueError: Multi-index search is only defined for frozen tries; call freeze() first.
+        >>> barcodes.freeze()
+        >>> barcodes.hamming_search('TCGT', 2, segments=3)
+        [('ACGT', 1), ('TCGA', 1), ('ACGA', 2)]
+        """
+        if max_mismatches < 0:
+            raise ValueError('max_mismatches must be non-negative (got %r)' %\
+                    (max_mismatches,))
+        symbols = list(query)
+        n = len(symbols)
+        if segments is None:
+            matches = list(self._hammingMatches(self._root, symbols,
+                max_mismatches))
+        else:
+            if not 1 <= segments <= n:
+                raise ValueError('segments must be between 1 and the length '\
+                        'of the query (got %r)' % (segments,))
+            found = {}
+            for start, stop, index in self._hammingIndexes(n, segments):
+                rotated = symbols[start:] + symbols[:start]
+                for key, mismatches in self._hammingMatches(index._root,
+                        rotated, max_mismatches, stop - start,
+                        max_mismatches // segments):
+                    found[key[n-start:] + key[:n-start]] = mismatches
+            matches = found.items()
+        matches.sort(key=lambda match: (match[1], match[0]))
+        return matches
+
+    def _hammingMatches(self, root, symbols, max_mismatches, head=0,
+            head_mismatches=0):
+        """
+        Generate the (key, mismatches) pairs of the keys under the given root
+        of the same length as the given symbols, that differ from them in at
+        most max_mismatches positions, and in at most head_mismatches of the
+        first head positions.
+        """
+        n = len(symbols)
+        stack = [(root, 0, 0, self._null_element)]
+        while stack:
+            node, depth, mismatches, prefix = stack.pop()
+            if depth == n:
+                if node[1]:
+                    yield prefix, mismatches
+                continue
+            el = symbols[depth]
+            budget = head_mismatches if depth < head else max_mismatches
+            if mismatches >= budget:
+                # only an exact match can continue
+                el_node = node[0].get(el)
+                if el_node is not None:
+                    stack.append((el_node, depth+1, mismatches, prefix+el))
+                continue
+            for child_el, el_node in node[0].iteritems():
+                stack.append((el_node, depth+1,
+                    mismatches if child_el == el else mismatches+1,
+                    prefix+child_el))
+
+    def _hammingIndexes(self, n, segments):
+        """
+        Return a list of (start, stop, index) triples, one per segment of keys
+        of length n: the bounds of the segment, and a TrieSet of those keys
+        rotated to begin at its start.
+        """
+        if not self._frozen:
+            raise ValueError('Multi-index search is only defined for frozen '\
+                    'tries; call freeze() first.')
+        cache = self.__dict__.setdefault('_hammingCache', {})
+        if (n, segments) not in cache:
+            keys = [key for key in self._iterKeys() if len(key) == n]
+            starts = [n*i // segments for i in xrange(segments)]
+            indexes = []
+            for start, stop in zip(starts, starts[1:] + [n]):
+                index = TrieSet(null_element=self._null_element)
+                for key in keys:
+                    index.add(key[start:] + key[:start])
+                index.freeze()
+                indexes.append((start, stop, index))
+            cache[(n, segments)] = indexes
+        return cache[(n, segments)]
+
+    def _subtreeCount(self, node):
+        """
+        Return the number of keys in the subtree of the given node, if the trie
+        keeps the size of every subtree.
+        """
+        raise ValueError('Count weights are only defined for frozen '\
+                'TrieSets; call freeze() first.')
+
     def maximal_prefix(self, string):
         """
         Return the longest key which is a prefix of the given string. Raise a
@@ -550,6 +1143,335 @@ class TrieBase(object):
 
         raise KeyError('No key is a prefix of %r.' % string)
 
+    def stats(self):
+        """
+        Return a dictionary describing the shape and approximate memory use of
+        the trie, useful for capacity planning and for comparing tries:
+            - `nodes`: the number of nodes, including the root.
+            - `members`: the number of contained keys.
+            - `depth_histogram`: maps depth to the number of nodes at it.
+            - `fanout_histogram`: maps number of children to the number of
+              nodes having that many.
+            - `chain_histogram`: maps length to the number of maximal chains of
+              non-member nodes with a single child (i.e., the nodes that a
+              path-compressed layout would eliminate).
+            - `estimated_bytes`: the approximate size in bytes of the node
+              lists, child dictionaries, distinct symbols and any extra node
+              data (e.g., TrieDict values), as reported by `sys.getsizeof`.
+            - `reverse_nodes`, `reverse_estimated_bytes`: the same for the
+              reverse index, if there is one.
+
+        >>> st = TrieSet(['abc', 'aac', 'adc', 'adce']).stats()
+        >>> st['nodes'], st['members']
+        (9, 4)
+
+        >>> sorted(st['depth_histogram'].items())
+        [(0, 1), (1, 1), (2, 3), (3, 3), (4, 1)]
+
+        >>> sorted(st['fanout_histogram'].items())
+        [(0, 3), (1, 5), (3, 1)]
+
+        >>> sorted(st['chain_histogram'].items())
+        [(1, 4)]
+
+        >>> st['estimated_bytes'] > 0
+        True
+
+        >>> 'reverse_nodes' in st
+        False
+        """
+        nodes = members = 0
+        nbytes = 0
+        symbols = {}
+        depths = {}
+        fanouts = {}
+        chains = {}
+
+        # identities of nodes seen so far, as nodes may be shared (see
+        # TrieSet.minimize); shared nodes are counted at the depth at which they
+        # are first found.
+        seen = set()
+        identity = self._nodeIdentity
+        # stack of (node, depth, length of single-child chain above node)
+        stack = [(self._root, 0, 0)]
+        while stack:
+            cur_node, depth, chain = stack.pop()
+            node_id = identity(cur_node)
+            if node_id in seen:
+                continue
+            seen.add(node_id)
+            children = cur_node[0]
+            fanout = len(children)
+
+            nodes += 1
+            if cur_node[1]:
+                members += 1
+            depths[depth] = depths.get(depth, 0) + 1
+            fanouts[fanout] = fanouts.get(fanout, 0) + 1
+            nbytes += sys.getsizeof(cur_node) + sys.getsizeof(children)
+            for extra in cur_node[2:]:
+                nbytes += sys.getsizeof(extra)
+
+            if fanout == 1 and not cur_node[1]:
+                chain += 1
+            else:
+                if chain:
+                    chains[chain] = chains.get(chain, 0) + 1
+                chain = 0
+
+            for el, el_node in children.iteritems():
+                symbols[id(el)] = el
+                stack.append((el_node, depth+1, chain))
+
+        for el in symbols.itervalues():
+            nbytes += sys.getsizeof(el)
+
+        result = {
+            'nodes': nodes,
+            'members': members,
+            'depth_histogram': depths,
+            'fanout_histogram': fanouts,
+            'chain_histogram': chains,
+            'estimated_bytes': nbytes,
+        }
+
+        if self._reverse is not None:
+            rnodes = rbytes = 0
+            stack = [self._reverse]
+            while stack:
+                cur_node = stack.pop()
+                rnodes += 1
+                rbytes += sys.getsizeof(cur_node) + \
+                        sys.getsizeof(cur_node[0])
+                stack.extend(cur_node[0].itervalues())
+            result['reverse_nodes'] = rnodes
+            result['reverse_estimated_bytes'] = rbytes
+
+        return result
+
+    def _nodeIdentity(self, node):
+        """
+        Return a value identifying a node for as long as the trie exists. The
+        nodes of most tries are kept alive by the trie, so their ids do.
+        """
+        return id(node)
+
+    def partition(self, k, weight=None, blobs=False):
+        """
+        Split the keys into k shards of contiguous lexicographic key ranges,
+        of near-equal total weight, and return a `TriePartition` holding the
+        shards and a routing table for sending queries to them. Raise a
+        ValueError if there are fewer than k keys.
+
+        weight, if given, should be a function from keys to non-negative
+        numbers, e.g. `len` or `sys.getsizeof` to balance bytes rather than
+        key counts (the default).
+
+        The shards are new, independent tries of the same kind and options as
+        this one. If blobs is True, each shard is instead frozen and pickled
+        (see `__reduce__`) to a string, ready to be shipped to the server that
+        will answer for it.
+
+        >>> t = TrieSet(['apple', 'apricot', 'banana', 'blueberry', 'cherry',
+        ...     'date', 'elderberry', 'fig', 'grape'])
+        >>> p = t.partition(3)
+        >>> p.boundaries
+        ['blueberry', 'elderberry']
+
+        >>> [sorted(shard) for shard in p.shards]
+        [['apple', 'apricot', 'banana'], ['blueberry', 'cherry', 'date'], ['elderberry', 'fig', 'grape']]
+
+        >>> p.route('cherry'), p.route('a'), p.route('zebra')
+        (1, 0, 2)
+
+        >>> p.route_extensions('b'), p.route_extensions('f')
+        ([0, 1], [2])
+
+        >>> p.route_prefixes('blueberrypie')
+        [0, 1]
+
+        >>> import cPickle
+        >>> p = t.partition(2, weight=len, blobs=True)
+        >>> [sorted(cPickle.loads(blob)) for blob in p.shards]
+        [['apple', 'apricot', 'banana', 'blueberry', 'cherry'], ['date', 'elderberry', 'fig', 'grape']]
+
+        >>> t.partition(10)
+        Traceback (most recent call last):
+            ...
+        ValueError: Cannot split 9 keys into 10 shards.
+        """
+        n = len(self)
+        if not 1 <= k <= n:
+            raise ValueError('Cannot split %d keys into %d shards.' % (n, k))
+        if weight is None:
+            total = float(n)
+        else:
+            total = float(sum(weight(key) for key in self._iterKeys()))
+
+        shards = [self._emptyLike()]
+        boundaries = []
+        cum = 0.0
+        for i, (key, node) in enumerate(self._iterSortedNodes()):
+            s = len(boundaries)
+            if s < k - 1 and len(shards[s]) and (cum >= total * (s+1) / k or
+                    n - i == k - 1 - s):
+                # start the next shard, leaving at least one key for each
+                # shard after it
+                boundaries.append(key)
+                shards.append(self._emptyLike())
+            shards[-1]._copyEntry(self, key, node)
+            cum += 1 if weight is None else weight(key)
+
+        if blobs:
+            for s, shard in enumerate(shards):
+                shard.freeze()
+                shards[s] = cPickle.dumps(shard, cPickle.HIGHEST_PROTOCOL)
+        return TriePartition(boundaries, shards)
+
+    def _iterSortedNodes(self):
+        """
+        Generate (key, node) for the contained keys in lexicographic order.
+        """
+        stack = [(self._null_element, self._root)]
+        while stack:
+            key, node = stack.pop()
+            if node[1]:
+                yield key, node
+            for el in sorted(node[0], reverse=True):
+                stack.append((key+el, node[0][el]))
+
+    def _emptyLike(self):
+        """
+        Return a new, empty trie of the same kind and options as this one, to
+        be filled by _copyEntry().
+        """
+        raise TypeError('%s cannot be partitioned.' % type(self).__name__)
+
+    def _copyEntry(self, source, key, node):
+        """
+        Add the key of the given node of the given source trie to this trie.
+        """
+        raise TypeError('%s cannot be partitioned.' % type(self).__name__)
+
+    def instrument(self, hook=None):
+        """
+        Switch on instrumentation of this trie. Afterwards, every call to one of
+        the public query methods (`__contains__`, `extensions`, `prefixes`,
+        etc.) counts:
+            - `probes`: child dictionary lookups made while walking the trie;
+            - `nodes`: nodes visited;
+            - `keys`: keys produced for the caller.
+
+        The counts of each call are added to running per-method totals (see
+        `call_counts`), and, if hook is given, passed to it as
+        `hook(method_name, counts)` when the call finishes, so that they can be
+        forwarded to a metrics system. For generator methods a call finishes
+        when the generator is exhausted or discarded. Work done by a method on
+        behalf of another public method is attributed to the outer one.
+
+        Instrumentation costs nothing while switched off; while on, it makes
+        queries several times slower. Calling instrument() again replaces the
+        hook.
+
+        >>> t = TrieSet(['abc', 'aac', 'adc', 'adce'])
+        >>> calls = []
+        >>> t.instrument(lambda name, counts:
+        ...     calls.append((name, sorted(counts.items()))))
+        >>> 'adc' in t
+        True
+
+        >>> calls
+        [('__contains__', [('keys', 0), ('nodes', 4), ('probes', 3)])]
+
+        >>> sorted(t.extensions('ad'))
+        ['adc', 'adce']
+
+        >>> calls[-1]
+        ('extensions', [('keys', 2), ('nodes', 6), ('probes', 2)])
+
+        >>> sorted(t.call_counts()['extensions'].items())
+        [('calls', 1), ('keys', 2), ('nodes', 6), ('probes', 2)]
+
+        >>> t.uninstrument()
+        >>> type(t) is TrieSet
+        True
+        """
+        if not isinstance(self, _CountingMixin):
+            self.__class__ = _instrumentedClass(self.__class__)
+            # work done outside of any counted call (e.g., by iteritems) is
+            # tallied into, and ignored in, _idleCounters
+            self._idleCounters = self._counters = _CallCounts()
+            self._callTotals = {}
+        self._hook = hook
+
+    def uninstrument(self):
+        """
+        Switch off instrumentation, discarding the hook and call counts.
+        """
+        if isinstance(self, _CountingMixin):
+            self.__class__ = self._uninstrumentedClass
+            del self._counters, self._idleCounters, self._callTotals, \
+                    self._hook
+
+    def call_counts(self, reset=False):
+        """
+        Return a dictionary mapping the names of public methods called since
+        instrument() (or the last reset) to dictionaries of their summed
+        `calls`, `probes`, `nodes` and `keys`. If reset is True, start counting
+        afresh. Raise a ValueError if the trie is not instrumented.
+        """
+        if not isinstance(self, _CountingMixin):
+            raise ValueError('Trie is not instrumented; call instrument() '\
+                    'first.')
+        totals = self._callTotals
+        if reset:
+            self._callTotals = {}
+        return totals
+
+    def ends_with(self, suffix):
+        """
+        Generate, in arbitrary order, those contained keys which end with the
+        given suffix. Requires a reverse index (see `reverse_index` in the
+        subclass constructors), and runs in time proportional to the length of
+        the suffix plus the size of the output.
+
+        See subclass docstrings for usage examples with each subclass.
+        """
+        node = self._reverseNodeOf(suffix)
+        if node is None:
+            return
+        for key in self._generateReversedKeys(node, suffix):
+            yield key
+
+    def count_ending_with(self, suffix):
+        """
+        Return the number of contained keys which end with the given suffix,
+        in time proportional to the length of the suffix. Requires a reverse
+        index.
+        """
+        node = self._reverseNodeOf(suffix)
+        if node is None:
+            return 0
+        return node[2]
+
+    def maximal_key_suffix_of(self, string):
+        """
+        Return the longest key which is a suffix of the given string. Raise a
+        KeyError if no keys are a suffix thereof. Requires a reverse index.
+
+        See subclass docstrings for usage examples with each subclass.
+        """
+        mi = None
+        for (i, node) in enumerate(self._reversePathTo(string)):
+            if node[1]:
+                # is a member
+                mi = i
+
+        if mi is not None:
+            return string[len(string)-mi:]
+
+        raise KeyError('No key is a suffix of %r.' % string)
+
 
 #===============================================================================
 
@@ -559,8 +1481,8 @@ class TrieSet(TrieBase):
     extensions, successors, prefix testing, and prefix matching. Generally
     emulates the interface of the built-in set type.
 
-    Elements must be string-like, and once added to the TrieSet, cannot be
-    removed (unlike a built-in set).
+    Elements must be string-like. Removing an element prunes the nodes that no
+    longer lead to any element.
 
     If given, contents should be a sequence of string-like objects with which to
     initially populate the TrieSet. 
@@ -569,6 +1491,11 @@ class TrieSet(TrieBase):
     type will be added to the TrieSet (see module documentation for definitions).
     If not given, it defaults to '', the null element for type str.
 
+    If reverse_index is True, a mirror trie of the reversed keys is maintained
+    alongside the TrieSet, enabling fast suffix-of-key queries (`ends_with`,
+    `count_ending_with`, `maximal_key_suffix_of`) at the cost of roughly
+    doubling the memory footprint.
+
     Examples
     ========
     >>> t = TrieSet(['abc', 'aac', 'adc', 'adce'])
@@ -723,10 +1650,49 @@ class TrieSet(TrieBase):
         ...
     KeyError: "'b' is not a prefix of any contained element."
 
+    Key suffixes (with a reverse index):
+    -----------------------
+    >>> r = TrieSet(['walking', 'talking', 'king', 'walked', 'ing'],
+    ...     reverse_index=True)
+    >>> sorted(r.ends_with('king'))
+    ['king', 'talking', 'walking']
+
+    >>> sorted(r.ends_with('ed'))
+    ['walked']
+
+    >>> sorted(r.ends_with('xyz'))
+    []
+
+    >>> set(r.ends_with('')) == set(r)
+    True
+
+    >>> r.count_ending_with('ing'), r.count_ending_with(''), \
+    ...     r.count_ending_with('xyz')
+    (4, 5, 0)
+
+    >>> r.maximal_key_suffix_of('stalking')
+    'talking'
+
+    >>> r.maximal_key_suffix_of('singing')
+    'ing'
+
+    >>> r.maximal_key_suffix_of('song')
+    Traceback (most recent call last):
+        ...
+    KeyError: "No key is a suffix of 'song'."
+
+    >>> (r | TrieSet([''])).maximal_key_suffix_of('song')
+    ''
+
+    >>> sorted(t.ends_with('c'))
+    Traceback (most recent call last):
+        ...
+    ValueError: Suffix queries need a reverse index; construct the trie with reverse_index=True.
+
     """
 
-    def __init__(self, contents=None, null_element=''):
-        super(TrieSet, self).__init__(null_element)
+    def __init__(self, contents=None, null_element='', reverse_index=False):
+        super(TrieSet, self).__init__(null_element, reverse_index)
 
         self.__len = 0
 
@@ -739,7 +1705,13 @@ class TrieSet(TrieBase):
         >>> t == eval(repr(t))
         True
 
+        >>> TrieSet(['ab'], reverse_index=True)
+        TrieSet(['ab'], null_element='', reverse_index=True)
+
         """
+        if self._reverse is not None:
+            return 'TrieSet(%r, null_element=%r, reverse_index=True)' % \
+                    (list(self), self._null_element)
         return 'TrieSet(%r, null_element=%r)' % (list(self),
                 self._null_element)
 
@@ -784,10 +1756,58 @@ class TrieSet(TrieBase):
         False
         """
 
+        self._checkMutable()
+        # encoded first, so that a record that cannot be logged fails the add
+        record = self._journal._encode('a', key) \
+                if self._journal is not None else None
         new_node = self._makePathTo(key)
         if not new_node[1]:
             self.__len += 1
             new_node[1] = True # is_member
+            self._addReversed(key)
+            if record is not None:
+                self._journal._write(record)
+
+    def remove(self, key):
+        """
+        Remove an element. Raise a KeyError if it is not contained.
+
+        >>> t = TrieSet(['a', 'ab', 'abc', 'b'])
+        >>> t.remove('ab')
+        >>> sorted(t), len(t)
+        (['a', 'abc', 'b'], 3)
+
+        >>> t.remove('abc')
+        >>> t.stats()['nodes']
+        3
+
+        >>> t.remove('x')
+        Traceback (most recent call last):
+            ...
+        KeyError: 'x'
+        """
+        record = self._journal._encode('d', key) \
+                if self._journal is not None else None
+        self._removeKey(key)
+        self.__len -= 1
+        if record is not None:
+            self._journal._write(record)
+
+    def discard(self, key):
+        """
+        Remove an element if it is contained.
+        """
+        try:
+            self.remove(key)
+        except KeyError:
+            pass
+
+    def _emptyLike(self):
+        return TrieSet(null_element=self._null_element,
+                reverse_index=self._reverse is not None)
+
+    def _copyEntry(self, source, key, node):
+        self.add(key)
 
     def update(self, keys):
         """
@@ -823,7 +1843,8 @@ class TrieSet(TrieBase):
         if self._null_element != trieset._null_element:
             raise ValueError
 
-        return TrieSet(set(self)|set(trieset), null_element=self._null_element)
+        return TrieSet(set(self)|set(trieset), null_element=self._null_element,
+                reverse_index=self._reverse is not None)
 
     __or__ = union
 
@@ -847,7 +1868,8 @@ class TrieSet(TrieBase):
         if self._null_element != trieset._null_element:
             raise ValueError
 
-        return TrieSet(set(self)&set(trieset), null_element=self._null_element)
+        return TrieSet(set(self)&set(trieset), null_element=self._null_element,
+                reverse_index=self._reverse is not None)
 
     __and__ = intersection
 
@@ -892,6 +1914,241 @@ class TrieSet(TrieBase):
         """
         return trieset.issubset(self)
 
+    def minimize(self):
+        """
+        Merge all equivalent subtrees of the trie (those containing the same
+        set of suffixes), turning it into a minimal acyclic word graph (DAWG),
+        and freeze it, since nodes may now be shared by many keys. All query
+        methods work as before. On natural-language lexicons, which repeat the
+        same suffixes ("-ing", "-tion", ...) under many prefixes, this
+        typically reduces the number of nodes by an order of magnitude.
+
+        Takes time linear in the number of nodes. Any reverse index is left
+        as it is.
+
+        >>> words = ['walk', 'walks', 'walked', 'walking', 'talk', 'talks',
+        ...     'talked', 'talking', 'balk', 'balked']
+        >>> t = TrieSet(words)
+        >>> t.stats()['nodes']
+        27
+
+        >>> t.minimize()
+        >>> t.stats()['nodes']
+        13
+
+        >>> sorted(t) == sorted(words), len(t)
+        (True, 10)
+
+        >>> sorted(t.extensions('talke')), t.maximal_prefix('walkingstick')
+        (['talked'], 'walking')
+
+        >>> sorted(t.successors('bal')), sorted(t.prefixes('balked'))
+        (['balk'], ['balk', 'balked'])
+
+        >>> 'balks' in t, 'balking' in t, 'balk' in t
+        (False, False, True)
+
+        >>> t.add('balks')
+        Traceback (most recent call last):
+            ...
+        TypeError: TrieSet is frozen.
+
+        >>> u = TrieSet(t)
+        >>> u.add('balks')
+        >>> 'balks' in u, 'talks' in u, len(u)
+        (True, True, 11)
+
+        Minimized tries pickle and copy with their sharing intact:
+
+        >>> import cPickle, copy
+        >>> lexicon = TrieSet(stem + suffix for stem in ('walk', 'talk', 'jump',
+        ...     'play', 'work', 'help') for suffix in ('', 's', 'ed', 'ing',
+        ...     'er', 'ers'))
+        >>> lexicon.minimize()
+        >>> for u in (cPickle.loads(cPickle.dumps(lexicon, 2)),
+        ...         copy.copy(lexicon)):
+        ...     sorted(u) == sorted(lexicon), u.stats() == lexicon.stats()
+        (True, True)
+        (True, True)
+        """
+        # maps ids of nodes visited so far to their canonical equivalents
+        canonical = {}
+        # maps (is_member, frozenset of (symbol, id of canonical child)) to
+        # the canonical node with that signature
+        signatures = {}
+
+        # iterative postorder traversal
+        stack = [(self._root, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if id(node) in canonical:
+                continue
+            children = node[0]
+            if not expanded:
+                stack.append((node, True))
+                for child in children.itervalues():
+                    if id(child) not in canonical:
+                        stack.append((child, False))
+                continue
+
+            for el, child in children.items():
+                children[el] = canonical[id(child)]
+            signature = (node[1], frozenset((el, id(child)) for el, child in
+                children.iteritems()))
+            canonical[id(node)] = signatures.setdefault(signature, node)
+
+        self._root = canonical[id(self._root)]
+        self.freeze()
+
+    def id_of(self, key):
+        """
+        Return the integer ID of a contained key: its rank in the
+        lexicographic order of all contained keys, so that IDs run densely
+        from 0 to `len(self) - 1`. Raise a KeyError if the key is not
+        contained.
+
+        IDs are only defined for frozen TrieSets (see `freeze` and `minimize`),
+        since adding a key would renumber its successors. The first call
+        annotates every node with the sorted symbols and key counts of its
+        subtrees, taking time linear in the number of nodes; afterwards both
+        `id_of` and `key_of` walk a single path, taking O(len(key) * log(f))
+        time for fanout f, with no auxiliary hash table.
+
+        >>> t = TrieSet(['b', 'a', 'ab', 'abc', 'c'])
+        >>> t.id_of('a')
+        Traceback (most recent call last):
+            ...
+        ValueError: IDs are only defined for frozen TrieSets; call freeze() first.
+
+        >>> t.freeze()
+        >>> [t.id_of(k) for k in sorted(t)]
+        [0, 1, 2, 3, 4]
+
+        >>> t.key_of(3), t.key_of(0)
+        ('b', 'a')
+
+        >>> t.ids_of(['c', 'a', 'abc']), t.keys_of([1, 2])
+        ([4, 0, 2], ['ab', 'abc'])
+
+        >>> t.id_of('abx')
+        Traceback (most recent call last):
+            ...
+        KeyError: 'abx'
+
+        >>> t.key_of(5)
+        Traceback (most recent call last):
+            ...
+        IndexError: ID 5 out of range.
+
+        Minimized TrieSets number keys the same way:
+        >>> words = ['walk', 'walked', 'talk', 'talked', 'balk']
+        >>> m = TrieSet(words)
+        >>> m.minimize()
+        >>> [m.key_of(i) for i in range(len(m))] == sorted(words)
+        True
+
+        >>> m.ids_of(sorted(words)) == range(len(words))
+        True
+        """
+        root = self._rankedRoot()
+        return self._idOf(root, key)
+
+    def key_of(self, id):
+        """
+        Return the contained key with the given ID (see `id_of`). Raise an
+        IndexError if there is no such ID.
+        """
+        root = self._rankedRoot()
+        return self._keyOf(root, id)
+
+    def ids_of(self, keys):
+        """
+        Return a list of the IDs of the given keys (see `id_of`).
+        """
+        root = self._rankedRoot()
+        idOf = self._idOf
+        return [idOf(root, key) for key in keys]
+
+    def keys_of(self, ids):
+        """
+        Return a list of the keys with the given IDs (see `id_of`).
+        """
+        root = self._rankedRoot()
+        keyOf = self._keyOf
+        return [keyOf(root, id) for id in ids]
+
+    def _idOf(self, root, key):
+        rank = 0
+        cur_node = root
+        for el in key:
+            symbols, starts, total = cur_node[2]
+            i = bisect.bisect_left(symbols, el)
+            if i == len(symbols) or symbols[i] != el:
+                raise KeyError(key)
+            rank += starts[i]
+            cur_node = cur_node[0][el]
+        if not cur_node[1]:
+            raise KeyError(key)
+        return rank
+
+    def _keyOf(self, root, id):
+        if not 0 <= id < root[2][2]:
+            raise IndexError('ID %r out of range.' % (id,))
+        key = self._null_element
+        cur_node = root
+        while not (cur_node[1] and id == 0):
+            symbols, starts, total = cur_node[2]
+            i = bisect.bisect_right(starts, id) - 1
+            id -= starts[i]
+            key = key + symbols[i]
+            cur_node = cur_node[0][symbols[i]]
+        return key
+
+    def _subtreeCount(self, node):
+        if not self._frozen:
+            return super(TrieSet, self)._subtreeCount(node)
+        self._rankedRoot()
+        return node[2][2]
+
+    def _rankedRoot(self):
+        """
+        Return the root, first annotating every node, if necessary, with a
+        tuple (sorted symbols, starts, total) at node[2]: the symbols of its
+        children in order, the rank within the node's subtree of the first key
+        under each child, and the number of keys in the subtree.
+        """
+        if not self._frozen:
+            raise ValueError('IDs are only defined for frozen TrieSets; '\
+                    'call freeze() first.')
+        if len(self._root) > 2:
+            return self._root
+
+        # iterative postorder traversal; nodes may be shared
+        done = set()
+        stack = [(self._root, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if id(node) in done:
+                continue
+            children = node[0]
+            if not expanded:
+                stack.append((node, True))
+                for child in children.itervalues():
+                    if id(child) not in done:
+                        stack.append((child, False))
+                continue
+
+            symbols = sorted(children)
+            starts = []
+            total = 1 if node[1] else 0
+            for el in symbols:
+                starts.append(total)
+                total += children[el][2][2]
+            node[2:] = [(symbols, starts, total)]
+            done.add(id(node))
+
+        return self._root
+
 #===============================================================================
 
 class TrieDict(TrieBase):
@@ -901,9 +2158,8 @@ class TrieDict(TrieBase):
     prefix testing, and prefix matching. Generally emulates the interface of the
     built-in dict type.
 
-    Keys must be string-like, and once added to the TrieDict, cannot be removed
-    (unlike a built-in dict), though the value mapped to by a key can be
-    overwritten.
+    Keys must be string-like. Removing a key prunes the nodes that no longer
+    lead to any key.
 
     If given, items should be one of the following:
         - a sequence of (key, value) tuples with which to initially populate the
@@ -916,37 +2172,224 @@ class TrieDict(TrieBase):
     type will be added to the TrieSet (see module documentation for definitions).
     If not given, it defaults to '', the null element for type str.
 
+    reverse_index has the same meaning as for `TrieSet`.
+
+    dtype, if given, declares that all values are numbers of one type, which
+    are then stored unboxed in a single contiguous `array.array` column rather
+    than as Python objects in the nodes; the member flag of each node holds
+    its slot in the column instead. This lets `values_array` and `sum_values`
+    work on the column in bulk. It saves memory only where values would
+    otherwise be objects of their own: about 24 bytes per key for floats and
+    for ints outside the range that Python caches (-5 to 256). For small ints,
+    such as most counts, it saves nothing, since each member node then holds
+    its slot as an int object instead. dtype may be 'int64' or 'float64', or
+    any `array` typecode ('l', 'd', 'i', 'f', etc.). Values of the wrong type
+    raise a TypeError.
+
     Examples
     ========
+    >>> d = TrieDict([('walking', 1), ('talking', 2), ('walked', 3)],
+    ...     reverse_index=True)
+    >>> sorted(d.ends_with('king'))
+    ['talking', 'walking']
+
+    >>> d['king'] = 4
+    >>> d['king'] = 5
+    >>> d.count_ending_with('king')
+    3
+
+    Typed values:
+    -----------------------
+    >>> f = TrieDict([('a', 0.5), ('ab', 1.5)], dtype='float64')
+    >>> f['abc'] = 2
+    >>> f['ab'] += 1
+    >>> sorted(f.items())
+    [('a', 0.5), ('ab', 2.5), ('abc', 2.0)]
+
+    >>> f.sum_values(), f.values_array()
+    (5.0, array('d', [0.5, 2.5, 2.0]))
+
+    >>> f['x'] = 'one'
+    Traceback (most recent call last):
+        ...
+    TypeError: a float is required
+
+    The rejected key leaves no trace:
+
+    >>> f.has_extension_of('x'), sorted(f), f.stats()['nodes']
+    (False, ['a', 'ab', 'abc'], 4)
+
+    >>> TrieDict([('a', 1)], dtype='int64')
+    TrieDict({'a': 1}, null_element='', dtype='l')
 
+    >>> TrieDict(dtype='complex')
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown dtype 'complex'.
     """
 
-    def __init__(self, items=None, null_element=''):
-        super(TrieDict, self).__init__(null_element)
+    _instrumentedMethods = TrieBase._instrumentedMethods + ('__getitem__',
+            'get')
+    _hasValues = True
+
+    def __init__(self, items=None, null_element='', reverse_index=False,
+            dtype=None):
+        super(TrieDict, self).__init__(null_element, reverse_index)
+
+        # for typed values: the array typecode, the column of values, and the
+        # slots of the column freed by removed keys (whose values are zeroed).
+        # member nodes of typed TrieDicts are [children, slot+1].
+        self._typecode = _arrayTypecode(dtype) if dtype is not None else None
+        self._column = None
+        self._freeSlots = None
+        if self._typecode is not None:
+            self._column = array.array(self._typecode)
+            self._freeSlots = []
 
         if items is not None:
             self.update(items)
 
     def __repr__(self):
-        return 'TrieDict(%r, null_element=%r)' % (dict(self.iteritems()),
-                self._null_element)
+        args = ['%r' % (dict(self.iteritems()),),
+                'null_element=%r' % (self._null_element,)]
+        if self._reverse is not None:
+            args.append('reverse_index=True')
+        if self._typecode is not None:
+            args.append('dtype=%r' % (self._typecode,))
+        return 'TrieDict(%s)' % ', '.join(args)
 
     def __setitem__(self, key, value):
+        self._checkMutable()
+        if self._column is not None:
+            # reject values the column cannot hold before adding any node
+            array.array(self._typecode, [value])
+        record = self._journal._encode('s', key, value) \
+                if self._journal is not None else None
         new_node = self._makePathTo(key)
-        new_node[1] = True # is_member
-        # set value
-        try:
-            new_node[2] = value
-        except IndexError:
-            new_node.append(value) 
+        if self._column is not None:
+            if new_node[1]:
+                self._column[new_node[1]-1] = value
+            else:
+                slot = self._newSlot(value)
+                self._addReversed(key)
+                new_node[1] = slot + 1
+        else:
+            if not new_node[1]:
+                self._addReversed(key)
+            new_node[1] = True # is_member
+            # set value
+            try:
+                new_node[2] = value
+            except IndexError:
+                new_node.append(value) 
+        if record is not None:
+            self._journal._write(record)
 
-    def __getitem__(self, key, value):
+    def __delitem__(self, key):
+        """
+        >>> d = TrieDict([('a', 1), ('ab', 2)], dtype='int64')
+        >>> del d['a']
+        >>> d.items()
+        [('ab', 2)]
+
+        >>> del d['a']
+        Traceback (most recent call last):
+            ...
+        KeyError: 'a'
+        """
+        record = self._journal._encode('d', key) \
+                if self._journal is not None else None
+        self._removeKey(key)
+        if record is not None:
+            self._journal._write(record)
+
+    def _releaseNode(self, node):
+        if self._column is not None:
+            self._freeSlot(node[1]-1)
+        else:
+            del node[2:]
+
+    def __getitem__(self, key):
         node = self._nodeOf(key)
         if not (node and node[1]):
             raise KeyError('%r' % key)
+        if self._column is not None:
+            return self._column[node[1]-1]
+        return node[2]
+
+    def get(self, key, default=None):
+        node = self._nodeOf(key)
+        if not (node and node[1]):
+            return default
+        if self._column is not None:
+            return self._column[node[1]-1]
+        return node[2]
+
+    def _valueOf(self, node):
+        if self._column is not None:
+            return self._column[node[1]-1]
         return node[2]
 
+    def _emptyLike(self):
+        return TrieDict(null_element=self._null_element,
+                reverse_index=self._reverse is not None,
+                dtype=self._typecode)
+
+    def _copyEntry(self, source, key, node):
+        if source._column is not None:
+            self[key] = source._column[node[1]-1]
+        else:
+            self[key] = node[2]
+
+    def _newSlot(self, value):
+        """
+        Store a value in a free slot of the column, and return the slot.
+        """
+        column = self._column
+        if self._freeSlots:
+            slot = self._freeSlots[-1]
+            column[slot] = value
+            self._freeSlots.pop()
+            return slot
+        column.append(value)
+        return len(column) - 1
+
+    def _freeSlot(self, slot):
+        self._column[slot] = 0
+        self._freeSlots.append(slot)
+
+    def values_array(self):
+        """
+        Return a new `array.array` of all values of a typed TrieDict (see
+        dtype), in arbitrary order, copied from the column in bulk. NumPy users
+        can wrap it without copying with `numpy.frombuffer`.
+        """
+        if self._column is None:
+            raise ValueError('TrieDict has no dtype.')
+        if not self._freeSlots:
+            return array.array(self._typecode, self._column)
+        free = set(self._freeSlots)
+        return array.array(self._typecode, (v for (i, v) in
+            enumerate(self._column) if i not in free))
+
+    def sum_values(self):
+        """
+        Return the sum of all values; for a typed TrieDict, computed over the
+        column in bulk.
+        """
+        if self._column is not None:
+            # free slots are zeroed
+            return sum(self._column)
+        return sum(self.itervalues())
+
     def iteritems(self):
+        if self._column is not None:
+            column = self._column
+            for node, keyfragment in self._generateSubNodes(self._root,
+                    self._null_element):
+                if node[1]:
+                    yield keyfragment, column[node[1]-1]
+            return
         for node, keyfragment in self._generateSubNodes(self._root,
                 self._null_element):
             if node[1]:
@@ -965,11 +2408,50 @@ class TrieDict(TrieBase):
         return list(self.itervalues())
 
     def itervalues(self):
+        if self._column is not None:
+            column = self._column
+            for node, keyfragment in self._generateSubNodes(self._root,
+                    self._null_element):
+                if node[1]:
+                    yield column[node[1]-1]
+            return
         for node, keyfragment in self._generateSubNodes(self._root,
                 self._null_element):
             if node[1]:
                 yield node[2]
 
+    def stats(self):
+        result = super(TrieDict, self).stats()
+        if self._column is not None:
+            # the column, plus the slot numbers too large to be cached ints
+            result['estimated_bytes'] += sys.getsizeof(self._column) + \
+                    sys.getsizeof(0) * max(0, len(self._column) - 256)
+        return result
+
+    stats.__doc__ = TrieBase.stats.__doc__
+
+    def __getstate__(self):
+        state = super(TrieDict, self).__getstate__()
+        # values are stored with the nodes
+        state['_column'] = state['_freeSlots'] = None
+        return state
+
+    def _nodeValues(self, nodes):
+        if self._column is None:
+            return super(TrieDict, self)._nodeValues(nodes)
+        column = self._column
+        return array.array(self._typecode,
+                [column[node[1]-1] for node in nodes]).tostring()
+
+    def _setNodeValues(self, nodes, values):
+        if self._typecode is None:
+            return super(TrieDict, self)._setNodeValues(nodes, values)
+        self._column = array.array(self._typecode)
+        self._column.fromstring(values)
+        self._freeSlots = []
+        for slot, node in enumerate(nodes):
+            node[1] = slot + 1
+
     def update(self, source):
         if hasattr(source, 'keys'):
             for k in source:
@@ -978,6 +2460,1641 @@ class TrieDict(TrieBase):
             for k,v in source:
                 self[k] = v
 
+    def count_ngrams(self, tokens, n, min_count=None):
+        """
+        Count the 1- to n-grams of a stream of tokens into this TrieDict,
+        adding 1 to the value of each n-gram (treating absent n-grams as 0).
+
+        tokens may be any iterable of symbols, i.e., of the elements yielded by
+        iterating over a key: characters for `str` keys, or length-1
+        `StringLike`s for `StringLike` keys (see `streamTokens`). It is consumed
+        lazily, holding only n tokens at a time, so it may be a generator over
+        an arbitrarily large file.
+
+        Rather than looking up each n-gram from the root, the longest n-gram
+        starting at each position is walked once, incrementing the count at
+        every node along the way, so counting takes O(len(tokens) * n) node
+        hops and materializes no keys (unless there is a reverse index, which
+        must be told about new keys).
+
+        If min_count is given, afterwards remove every key of the TrieDict
+        whose count is less than min_count, along with the nodes that then lead
+        to no key.
+
+        A TrieDict with a `TrieJournal` cannot count n-grams, which would log
+        every update of a count; count into one without, and make it the
+        journal's snapshot instead (see `TrieJournal`).
+
+        >>> d = TrieDict()
+        >>> d.count_ngrams('abcab', 2)
+        >>> sorted(d.items())
+        [('a', 2), ('ab', 2), ('b', 2), ('bc', 1), ('c', 1), ('ca', 1)]
+
+        >>> d.count_ngrams('abd', 3, min_count=2)
+        >>> sorted(d.items())
+        [('a', 3), ('ab', 3), ('b', 3)]
+
+        >>> w = TrieDict(null_element=StringLike.Empty)
+        >>> w.count_ngrams(streamTokens(['the cat sat', 'the cat ran']), 2,
+        ...     min_count=2)
+        >>> sorted(w.items())
+        [(StringLike(('cat',)), 2), (StringLike(('the',)), 2), (StringLike(('the', 'cat')), 2)]
+        """
+        if n < 1:
+            raise ValueError('n must be at least 1 (got %r)' % (n,))
+        self._checkMutable()
+        if self._journal is not None:
+            raise TypeError('A TrieDict with a journal cannot count n-grams.')
+
+        window = collections.deque()
+        for tok in tokens:
+            window.append(tok)
+            if len(window) == n:
+                self._countPath(window)
+                window.popleft()
+        # the last n-1 positions have fewer than n tokens left
+        while window:
+            self._countPath(window)
+            window.popleft()
+
+        if min_count is not None:
+            self._pruneCounts(min_count)
+
+    def _countPath(self, symbols):
+        indexed = self._reverse is not None
+        column = self._column
+        gram = self._null_element
+        cur_node = self._root
+        for el in symbols:
+            try:
+                cur_node = cur_node[0][el]
+            except KeyError:
+                new_node = [{}, False]
+                cur_node[0][el] = new_node
+                cur_node = new_node
+            if indexed:
+                gram = gram + el
+            if column is not None:
+                if cur_node[1]:
+                    column[cur_node[1]-1] += 1
+                else:
+                    cur_node[1] = self._newSlot(1) + 1
+                    if indexed:
+                        self._addReversed(gram)
+            elif cur_node[1]:
+                cur_node[2] += 1
+            else:
+                cur_node[1] = True # is_member
+                cur_node[2:] = [1]
+                if indexed:
+                    self._addReversed(gram)
+
+    def _pruneCounts(self, min_count):
+        indexed = self._reverse is not None
+
+        # (parent's children, symbol, node, key) in preorder, so that reversing
+        # it visits every node after all of its descendants
+        order = []
+        stack = [(None, None, self._root, self._null_element)]
+        while stack:
+            item = stack.pop()
+            order.append(item)
+            children, el, node, key = item
+            for el, el_node in node[0].iteritems():
+                stack.append((node[0], el, el_node,
+                    key+el if indexed else None))
+
+        column = self._column
+        for children, el, node, key in reversed(order):
+            if not node[1]:
+                pass
+            elif column is not None:
+                if column[node[1]-1] < min_count:
+                    self._freeSlot(node[1]-1)
+                    node[1] = False
+                    if indexed:
+                        self._removeReversed(key)
+            elif node[2] < min_count:
+                node[1] = False
+                del node[2:]
+                if indexed:
+                    self._removeReversed(key)
+            if children is not None and not (node[1] or node[0]):
+                del children[el]
+
+# the estimated size of a node without values: its list and children dict
+_NODE_BYTES = sys.getsizeof([{}, False]) + sys.getsizeof({})
+
+class BoundedTrieDict(TrieDict):
+    """
+    A TrieDict holding at most `max_keys` keys and/or an estimated
+    `max_bytes` of nodes and values, for use as a cache. Adding a key beyond
+    the bounds evicts other keys, pruning their unused nodes, according to the
+    `policy`:
+        - `'lru'` (the default) evicts the least recently used key.
+        - `'lfu'` evicts the least frequently used key, the least recently
+          used among equally frequent ones.
+    Setting a key, and getting it through `__getitem__`, `get`,
+    `maximal_prefix` or `prefixes`, counts as using it; `in` does not.
+
+    >>> cache = BoundedTrieDict(max_keys=2)
+    >>> cache['/a'] = 1
+    >>> cache['/b'] = 2
+    >>> cache.maximal_prefix('/a/index.html')
+    '/a'
+    >>> cache['/c'] = 3
+    >>> sorted(cache.items()), cache.evictions
+    ([('/a', 1), ('/c', 3)], 1)
+
+    >>> cache = BoundedTrieDict(max_keys=2, policy='lfu')
+    >>> cache['x'] = 1
+    >>> cache['y'] = 2
+    >>> cache['x'], cache['x'], cache['y']
+    (1, 1, 2)
+    >>> cache['z'] = 3
+    >>> sorted(cache)
+    ['x', 'z']
+
+    Hits on cached keys leave stale entries behind in the usage heap, which is
+    compacted as they pile up:
+
+    >>> for i in xrange(10000):
+    ...     value = cache['x' if i % 3 else 'z']
+    >>> len(cache._heap) <= 2*len(cache) + 64
+    True
+
+    The estimated bytes are those of the nodes and values, as in `stats()`:
+    each key is charged for the nodes it adds to the trie, and credited for
+    those its eviction prunes.
+
+    >>> cache = BoundedTrieDict(max_bytes=3000)
+    >>> for i in xrange(100):
+    ...     cache['key%03d' % i] = i
+    >>> cache.estimated_bytes <= 3000 < cache.estimated_bytes + 300
+    True
+    >>> len(cache) < 100 and cache.evictions == 100 - len(cache)
+    True
+
+    Copies keep their own usage records:
+
+    >>> import copy
+    >>> cache = BoundedTrieDict(max_keys=2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> other = copy.deepcopy(cache)
+    >>> other['z'] = 3
+    >>> cache['q'] = 5
+    >>> cache['r'] = 6
+    >>> sorted(cache), sorted(other)
+    (['q', 'r'], ['b', 'z'])
+    """
+
+    def __init__(self, items=None, null_element='', max_keys=None,
+            max_bytes=None, policy='lru', reverse_index=False, dtype=None):
+        if max_keys is None and max_bytes is None:
+            raise ValueError('max_keys or max_bytes must be given.')
+        if max_keys is not None and max_keys < 1:
+            raise ValueError('max_keys must be at least 1 (got %r)' %\
+                    (max_keys,))
+        if policy not in ('lru', 'lfu'):
+            raise ValueError("policy must be 'lru' or 'lfu' (got %r)" %\
+                    (policy,))
+        self.max_keys = max_keys
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.evictions = 0
+        self._bytes = _NODE_BYTES
+        # lru: keys from least to most recently used. lfu: the (uses, tick)
+        # of each key, and a heap of (uses, tick, key) entries, some stale.
+        self._uses = collections.OrderedDict() if policy == 'lru' else {}
+        self._heap = []
+        self._tick = 0
+        # false while journaled modifications, evictions included, are
+        # replayed
+        self._evicting = True
+        super(BoundedTrieDict, self).__init__(items, null_element,
+                reverse_index, dtype)
+
+    def __repr__(self):
+        args = ['%r' % (dict(self.iteritems()),),
+                'null_element=%r' % (self._null_element,),
+                'max_keys=%r' % (self.max_keys,),
+                'max_bytes=%r' % (self.max_bytes,),
+                'policy=%r' % (self.policy,)]
+        if self._reverse is not None:
+            args.append('reverse_index=True')
+        if self._typecode is not None:
+            args.append('dtype=%r' % (self._typecode,))
+        return 'BoundedTrieDict(%s)' % ', '.join(args)
+
+    @property
+    def estimated_bytes(self):
+        return self._bytes
+
+    def __getstate__(self):
+        state = super(BoundedTrieDict, self).__getstate__()
+        state['_uses'] = copy.copy(self._uses)
+        state['_heap'] = list(self._heap)
+        return state
+
+    def _valueBytes(self, value):
+        if self._column is not None:
+            return self._column.itemsize
+        return sys.getsizeof(value)
+
+    def __setitem__(self, key, value):
+        # how much of the key's path exists already
+        cur_node = self._root
+        depth = 0
+        for el in key:
+            el_node = cur_node[0].get(el)
+            if el_node is None:
+                break
+            cur_node = el_node
+            depth += 1
+        old_bytes = 0
+        if depth == len(key) and cur_node[1]:
+            old_bytes = self._valueBytes(
+                    super(BoundedTrieDict, self).__getitem__(key))
+
+        super(BoundedTrieDict, self).__setitem__(key, value)
+        self._bytes += (len(key) - depth)*_NODE_BYTES + \
+                self._valueBytes(value) - old_bytes
+        self._use(key)
+        if self._evicting:
+            self._evictFor(key)
+
+    def __delitem__(self, key):
+        value = super(BoundedTrieDict, self).__getitem__(key)
+        super(BoundedTrieDict, self).__delitem__(key)
+        self._bytes -= self._valueBytes(value)
+        del self._uses[key]
+        if self.policy == 'lfu':
+            self._compactHeap()
+
+    def _removeKey(self, key):
+        pruned = super(BoundedTrieDict, self)._removeKey(key)
+        self._bytes -= pruned*_NODE_BYTES
+        return pruned
+
+    def _use(self, key):
+        uses = self._uses
+        if self.policy == 'lru':
+            uses.pop(key, None)
+            uses[key] = None
+        else:
+            self._tick += 1
+            entry = (uses[key][0] + 1 if key in uses else 1, self._tick)
+            uses[key] = entry
+            heapq.heappush(self._heap, entry + (key,))
+            self._compactHeap()
+
+    def _compactHeap(self):
+        """
+        Rebuild the heap without its stale entries once they outnumber the
+        live ones, so that neither hits nor deletions grow it unboundedly.
+        """
+        if len(self._heap) > 2*len(self._uses) + 64:
+            self._heap = [(uses, tick, k) for k, (uses, tick) in
+                    self._uses.iteritems()]
+            heapq.heapify(self._heap)
+
+    def _overBounds(self):
+        return (self.max_keys is not None and
+                len(self._uses) > self.max_keys) or \
+                (self.max_bytes is not None and self._bytes > self.max_bytes)
+
+    def _evictFor(self, key):
+        """
+        Evict keys other than the given one until the bounds are met.
+        """
+        while len(self._uses) > 1 and self._overBounds():
+            if self.policy == 'lru':
+                victim = next(iter(self._uses))
+            else:
+                heap = self._heap
+                held = None
+                while True:
+                    uses, tick, victim = heapq.heappop(heap)
+                    if self._uses.get(victim) != (uses, tick):
+                        # stale
+                        continue
+                    if victim != key:
+                        break
+                    held = (uses, tick, victim)
+                if held is not None:
+                    heapq.heappush(heap, held)
+            del self[victim]
+            self.evictions += 1
+
+    def __getitem__(self, key):
+        value = super(BoundedTrieDict, self).__getitem__(key)
+        self._use(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def maximal_prefix(self, string):
+        key = super(BoundedTrieDict, self).maximal_prefix(string)
+        self._use(key)
+        return key
+
+    def prefixes(self, string):
+        for key in super(BoundedTrieDict, self).prefixes(string):
+            self._use(key)
+            yield key
+
+    def count_ngrams(self, tokens, n, min_count=None):
+        raise TypeError('BoundedTrieDict cannot count n-grams.')
+
+    def _applyLogged(self, op, args):
+        self._evicting = False
+        try:
+            super(BoundedTrieDict, self)._applyLogged(op, args)
+        finally:
+            self._evicting = True
+
+    def _emptyLike(self):
+        return BoundedTrieDict(null_element=self._null_element,
+                max_keys=self.max_keys, max_bytes=self.max_bytes,
+                policy=self.policy, reverse_index=self._reverse is not None,
+                dtype=self._typecode)
+
+class TrieView(TrieBase):
+    """
+    A read-only view of the keys of a trie that begin with some prefix, as
+    returned by `TrieBase.view`. The view shares the trie's nodes, so it is
+    created in time proportional to the length of the prefix, and reflects
+    later modifications of the trie under the prefix. (If every key under the
+    prefix is removed, though, its nodes are pruned, and the view no longer
+    sees the trie; take a new one.)
+
+    All the query methods of TrieBase work on views, with keys, prefixes and
+    strings relative to the view's prefix:
+
+    >>> t = TrieDict([('en/cat', 1), ('en/car', 2), ('en/ca', 3), ('de/kat', 4)])
+    >>> v = t.view('en/')
+    >>> v.prefix
+    'en/'
+    >>> sorted(v.successors('ca'))
+    ['car', 'cat']
+    >>> sorted(v.extensions('car'))
+    ['car']
+    >>> sorted(v.prefixes('cart'))
+    ['ca', 'car']
+    >>> v['cat'], v.get('dog')
+    (1, None)
+    >>> t['en/cab'] = 5
+    >>> len(v), len(v.view('ca'))
+    (4, 4)
+
+    Views cannot be modified, copied, pickled or partitioned.
+
+    >>> import copy
+    >>> copy.copy(v)
+    Traceback (most recent call last):
+        ...
+    TypeError: TrieView cannot be pickled or copied.
+
+    >>> v.partition(2)
+    Traceback (most recent call last):
+        ...
+    TypeError: TrieView cannot be partitioned.
+    """
+
+    def __init__(self, trie, prefix, node):
+        # shares the trie's nodes instead of calling TrieBase.__init__
+        self._null_element = trie._null_element
+        self._root = node
+        self._reverse = None
+        self._frozen = True
+        self._journal = None
+        self._trie = trie
+        self._hasValues = trie._hasValues
+        self.prefix = prefix
+
+    def __repr__(self):
+        return '<TrieView of %s under %r>' % (type(self._trie).__name__,
+                self.prefix)
+
+    def __len__(self):
+        return int(bool(self._root[1])) + super(TrieView, self).__len__()
+
+    def __getitem__(self, key):
+        node = self._nodeOf(key)
+        if not (node and node[1]):
+            raise KeyError('%r' % key)
+        return self._valueOf(node)
+
+    def get(self, key, default=None):
+        node = self._nodeOf(key)
+        if not (node and node[1]):
+            return default
+        return self._valueOf(node)
+
+    def _valueOf(self, node):
+        return self._trie._valueOf(node)
+
+    def _subtreeCount(self, node):
+        return self._trie._subtreeCount(node)
+
+    def view(self, prefix):
+        node = self._nodeOf(prefix)
+        if node is None:
+            raise KeyError('%r is not a prefix of any contained element.' %\
+                    prefix)
+        return TrieView(self._trie, self.prefix + prefix, node)
+
+    def _checkMutable(self):
+        raise TypeError('TrieView is read-only.')
+
+    def __reduce__(self, memo=None):
+        raise TypeError('TrieView cannot be pickled or copied.')
+
+    __copy__ = __deepcopy__ = __reduce__
+
+@contextlib.contextmanager
+def _gcPaused():
+    """
+    Suspend the cyclic garbage collector, which would otherwise run over and
+    over while millions of node lists and dicts are created, none of which can
+    be garbage.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+# names accepted as TrieDict dtypes, besides array typecodes
+_DTYPES = {'int64': 'l', 'float64': 'd', 'int32': 'i', 'float32': 'f'}
+
+def _arrayTypecode(dtype):
+    typecode = _DTYPES.get(dtype, dtype)
+    try:
+        column = array.array(typecode)
+    except (TypeError, ValueError):
+        raise ValueError('Unknown dtype %r.' % (dtype,))
+    if dtype == 'int64' and column.itemsize != 8:
+        raise ValueError('int64 values are not supported on this platform.')
+    return typecode
+
+def _newTrie(cls):
+    """
+    Return an uninitialized instance of a trie class, for unpickling.
+    """
+    return cls.__new__(cls)
+
+def _packInts(ints):
+    """
+    Return the given non-negative integers as a (typecode, string) pair, using
+    the narrowest array type that holds them.
+    """
+    largest = max(ints) if ints else 0
+    for typecode in 'BHIL':
+        if largest < 2 ** (8 * array.array(typecode).itemsize):
+            return typecode, array.array(typecode, ints).tostring()
+    raise OverflowError('Trie too large to pack.')
+
+def _unpackInts(packed):
+    typecode, data = packed
+    ints = array.array(typecode)
+    ints.fromstring(data)
+    return ints
+
+def streamTokens(lines, sep=None):
+    """
+    Generate the tokens of each of the given lines (e.g., of an open file),
+    split by sep as in `str.split`, as length-1 StringLikes, suitable for
+    `TrieDict.count_ngrams` on a TrieDict of StringLikes.
+
+    >>> list(streamTokens(['to be', 'or not']))
+    [StringLike(('to',)), StringLike(('be',)), StringLike(('or',)), StringLike(('not',))]
+    """
+    for line in lines:
+        for tok in line.split(sep):
+            yield StringLike((tok,))
+
+#===============================================================================
+
+class TriePartition(object):
+    """
+    The result of `TrieBase.partition`: a list of shards, each holding a
+    contiguous range of keys in lexicographic order, and the routing table
+    `boundaries`, in which `boundaries[i-1]` is the least key of shard i.
+    Routing only needs the boundaries, so clients can hold just those.
+    """
+
+    def __init__(self, boundaries, shards):
+        self.boundaries = boundaries
+        self.shards = shards
+
+    def __repr__(self):
+        return '<TriePartition of %d shards, boundaries=%r>' % \
+                (len(self.shards), self.boundaries)
+
+    def route(self, key):
+        """
+        Return the index of the shard that would contain the given key, i.e.,
+        that answers `__contains__` (and, for TrieDicts, lookups) for it.
+        """
+        return bisect.bisect_right(self.boundaries, key)
+
+    def route_extensions(self, prefix):
+        """
+        Return the indexes of the shards that may contain extensions of the
+        given prefix, i.e., that must all be asked for `extensions(prefix)`.
+        Shards other than the first may raise KeyError if they contain no
+        extension of it.
+        """
+        first = self.route(prefix)
+        last = first
+        boundaries = self.boundaries
+        while last < len(boundaries) and boundaries[last].startswith(prefix):
+            last += 1
+        return range(first, last + 1)
+
+    def route_prefixes(self, string):
+        """
+        Return the indexes of the shards that may contain prefixes of the given
+        string, i.e., that must all be asked for `prefixes(string)`.
+        """
+        return sorted(set(self.route(string[:i])
+            for i in xrange(len(string) + 1)))
+
+#===============================================================================
+
+# a journal log starts with a header naming the generation of the snapshot it
+# applies to; each record is a '<II' length and CRC-32, then a pickled
+# (op, args...) tuple.
+_JOURNAL_MAGIC = 'MYTRIEJ1'
+_JOURNAL_HEADER = struct.Struct('<8sQ')
+_JOURNAL_RECORD = struct.Struct('<II')
+
+class TrieJournal(object):
+    """
+    Incremental persistence for a TrieSet or TrieDict: a snapshot file at
+    `path`, plus a log at `path + '.log'` to which every modification of the
+    trie (`add`, `__setitem__`, `remove` and `__delitem__`) is appended as it
+    is made. `checkpoint()` writes a new snapshot and empties the
+    log, so the cost of a modification, and of recovery by `open()`, depends on
+    the number of modifications since the last checkpoint, not on the size of
+    the trie.
+
+    >>> import os, shutil, tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> path = os.path.join(tmpdir, 'counts')
+    >>> journal = TrieJournal(path)
+    >>> d = journal.open()
+    >>> d['a'] = 1
+    >>> d['ab'] = 2
+    >>> journal.checkpoint()
+    >>> d['abc'] = 3
+    >>> del d['a']
+
+    A process that dies here loses nothing: reopening loads the snapshot and
+    replays the log on top of it.
+
+    >>> journal.close()
+    >>> journal = TrieJournal(path)
+    >>> sorted(journal.open().items())
+    [('ab', 2), ('abc', 3)]
+
+    A record left incomplete by a crash mid-write is discarded.
+
+    >>> journal.trie['b'] = 4
+    >>> journal.close()
+    >>> with open(path + '.log', 'ab') as f:
+    ...     f.write('torn')
+    >>> journal = TrieJournal(path)
+    >>> sorted(journal.open())
+    ['ab', 'abc', 'b']
+    >>> journal.close()
+
+    A journaled TrieDict cannot count n-grams, which would log every update
+    of a count. Count into a TrieDict without a journal, and make it the
+    snapshot of a new journal instead:
+
+    >>> counts = TrieDict()
+    >>> counts.count_ngrams('abcab', 2)
+    >>> journal = TrieJournal(os.path.join(tmpdir, 'ngrams'))
+    >>> journal.open(factory=lambda: counts) is counts
+    True
+    >>> journal.checkpoint()
+    >>> counts.count_ngrams('abc', 2)
+    Traceback (most recent call last):
+        ...
+    TypeError: A TrieDict with a journal cannot count n-grams.
+    >>> journal.close()
+    >>> shutil.rmtree(tmpdir)
+
+    If `sync` is true, the log is fsync'd after every record, so that
+    modifications survive a crash of the operating system as well as of the
+    process, at a considerable cost in speed.
+    """
+
+    def __init__(self, path, sync=False):
+        self.path = path
+        self.log_path = path + '.log'
+        self.sync = sync
+        # the attached trie, and the generation of its last snapshot
+        self.trie = None
+        self.generation = 0
+        self._log = None
+
+    def __repr__(self):
+        return '<TrieJournal %r, generation %d>' % (self.path, self.generation)
+
+    def open(self, factory=None):
+        """
+        Load the trie from the snapshot, if any (otherwise create it by calling
+        `factory`, by default `TrieDict`), replay the log on top of it, and
+        attach this journal to it. Return the trie.
+        """
+        if self.trie is not None:
+            raise ValueError('Journal is already open.')
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                with _gcPaused():
+                    self.generation, trie = cPickle.load(f)
+        else:
+            self.generation = 0
+            trie = (factory or TrieDict)()
+
+        if os.path.exists(self.log_path):
+            self._log = open(self.log_path, 'r+b')
+            self._replay(trie)
+        else:
+            self._log = open(self.log_path, 'w+b')
+            self._resetLog()
+        trie._journal = self
+        self.trie = trie
+        return trie
+
+    def checkpoint(self):
+        """
+        Atomically replace the snapshot with the current state of the trie,
+        then empty the log.
+        """
+        if self.trie is None:
+            raise ValueError('Journal is not open.')
+        self.generation += 1
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump((self.generation, self.trie), f,
+                    cPickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        # a crash between here and the log being reset leaves a log of an
+        # older generation, which open() ignores
+        os.rename(tmp_path, self.path)
+        self._resetLog()
+
+    def close(self):
+        """
+        Detach the journal from its trie and close the log.
+        """
+        if self.trie is not None:
+            self.trie._journal = None
+            self.trie = None
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _resetLog(self):
+        log = self._log
+        log.seek(0)
+        log.truncate()
+        log.write(_JOURNAL_HEADER.pack(_JOURNAL_MAGIC, self.generation))
+        log.flush()
+        os.fsync(log.fileno())
+
+    def _replay(self, trie):
+        """
+        Apply the log's records to the trie, truncating the log after the last
+        intact one. A log of another generation is already contained in the
+        snapshot, and is reset.
+        """
+        log = self._log
+        header = log.read(_JOURNAL_HEADER.size)
+        if len(header) < _JOURNAL_HEADER.size or \
+                _JOURNAL_HEADER.unpack(header) != \
+                (_JOURNAL_MAGIC, self.generation):
+            self._resetLog()
+            return
+        end = log.tell()
+        while True:
+            head = log.read(_JOURNAL_RECORD.size)
+            if len(head) < _JOURNAL_RECORD.size:
+                break
+            length, crc = _JOURNAL_RECORD.unpack(head)
+            data = log.read(length)
+            if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                break
+            record = cPickle.loads(data)
+            trie._applyLogged(record[0], record[1:])
+            end = log.tell()
+        log.seek(end)
+        log.truncate()
+
+    def _encode(self, op, *args):
+        """
+        Return the log record of a modification, to be written by `_write`
+        once the modification is applied. Raise a ValueError if it is too
+        large to log.
+        """
+        data = cPickle.dumps((op,) + args, cPickle.HIGHEST_PROTOCOL)
+        if len(data) > 0xffffffff:
+            raise ValueError('Journal record of %d bytes is too large.' %\
+                    len(data))
+        return data
+
+    def _write(self, data):
+        """
+        Append an encoded modification, already applied to the trie, to the
+        log.
+        """
+        log = self._log
+        log.write(_JOURNAL_RECORD.pack(len(data), zlib.crc32(data) & 0xffffffff))
+        log.write(data)
+        log.flush()
+        if self.sync:
+            os.fsync(log.fileno())
+
+#===============================================================================
+
+class BitTrie(object):
+    """
+    A mapping from bit-string prefixes to values, for longest-prefix matching
+    of integers, such as IP addresses against a routing table. A key is a pair
+    `(value, length)` naming the `length` most significant bits of the
+    `width`-bit integer `value`; its remaining bits must be zero.
+
+    >>> def ip(s): return reduce(lambda a, b: a << 8 | int(b), s.split('.'), 0)
+    >>> routes = BitTrie([((ip('10.0.0.0'), 8), 'a'), ((ip('10.1.0.0'), 16), 'b'),
+    ...     ((0, 0), 'default')])
+    >>> routes.longest_match(ip('10.1.2.3')) == (ip('10.1.0.0'), 16)
+    True
+    >>> routes[routes.longest_match(ip('10.2.0.1'))]
+    'a'
+    >>> [routes[k] for k in routes.all_matches(ip('10.1.2.3'))]
+    ['default', 'a', 'b']
+
+    `longest_match` and `all_matches` are the counterparts of `maximal_prefix`
+    and `prefixes` (generating the matches from shortest to longest):
+
+    >>> del routes[(0, 0)]
+    >>> routes.longest_match(ip('192.168.0.1'))
+    Traceback (most recent call last):
+        ...
+    KeyError: 'No key is a prefix of 3232235521.'
+    >>> list(routes.all_matches(ip('192.168.0.1')))
+    []
+
+    Instead of one node per bit, each node consumes `stride` bits (which must
+    divide `width`) in one dict lookup. A prefix whose length is not a multiple
+    of the stride is expanded into every `stride`-bit chunk it covers, and each
+    chunk maps to the prefixes covering it, longest last. Chains of nodes
+    without prefixes are compressed into their first descendant that has one,
+    which checks the skipped bits in a single comparison. Matching thus takes
+    at most `width / stride` node hops, and fewer in sparse tables.
+
+    >>> t = BitTrie(width=8, stride=4)
+    >>> t[(0b10100000, 3)] = 1
+    >>> t[(0b10110000, 4)] = 2
+    >>> t[(0b10110110, 7)] = 3
+    >>> sorted(t)
+    [(160, 3), (176, 4), (182, 7)]
+    >>> list(t.all_matches(0b10110111))
+    [(160, 3), (176, 4), (182, 7)]
+    >>> t[(0b10100001, 3)] = 4
+    Traceback (most recent call last):
+        ...
+    ValueError: Key (161, 3) has bits set beyond its length.
+    """
+
+    def __init__(self, items=None, width=32, stride=8):
+        if stride < 1 or width < stride or width % stride:
+            raise ValueError('stride must divide width (got width=%r, '\
+                    'stride=%r)' % (width, stride))
+        self.width = width
+        self.stride = stride
+        # values by key
+        self._values = {}
+        # nodes are [depth, skip, skip_mask, children, matches]: the node
+        # consumes the depth'th stride-bit chunk, and is reached from its
+        # parent only if the chunks between them, masked by skip_mask, equal
+        # skip. children maps chunks to nodes, and matches maps chunks to a
+        # tuple of the keys ending at this node that cover them, by length.
+        self._root = [0, 0, 0, {}, {}]
+        # the zero-length key, which matches everything
+        self._default = None
+        if items is not None:
+            self.update(items)
+
+    def __repr__(self):
+        return 'BitTrie(%r, width=%r, stride=%r)' % (self._values, self.width,
+                self.stride)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(sorted(self._values))
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def keys(self):
+        return sorted(self._values)
+
+    def items(self):
+        return sorted(self._values.iteritems())
+
+    def update(self, source):
+        if hasattr(source, 'keys'):
+            for k in source.keys():
+                self[k] = source[k]
+        else:
+            for k, v in source:
+                self[k] = v
+
+    def _checkKey(self, key):
+        """
+        Return the depth of the node at which the given key ends, and the
+        chunk of its value consumed there; raise an error if it is not a
+        valid key.
+        """
+        try:
+            value, length = key
+        except (TypeError, ValueError):
+            raise TypeError('Key must be a (value, length) pair (got %r)' %\
+                    (key,))
+        if not 0 <= length <= self.width:
+            raise ValueError('Key %r has length outside [0, %d].' %\
+                    (key, self.width))
+        if not 0 <= value < 1 << self.width:
+            raise ValueError('Key %r has a value outside [0, 2**%d).' %\
+                    (key, self.width))
+        if value & ((1 << (self.width - length)) - 1):
+            raise ValueError('Key %r has bits set beyond its length.' % (key,))
+        depth = (length - 1) // self.stride
+        return depth, self._chunk(value, depth)
+
+    def _chunk(self, value, depth):
+        return (value >> (self.width - (depth+1)*self.stride)) & \
+                ((1 << self.stride) - 1)
+
+    def _covered(self, key, depth, chunk):
+        """
+        Return the chunks of its node that a key covers.
+        """
+        unused = (depth+1)*self.stride - key[1]
+        return xrange(chunk, chunk + (1 << unused))
+
+    def __setitem__(self, key, value):
+        depth, chunk = self._checkKey(key)
+        if key not in self._values:
+            if key[1] == 0:
+                self._default = key
+            else:
+                node = self._makeNodeAt(key[0], depth)
+                matches = node[4]
+                for c in self._covered(key, depth, chunk):
+                    keys = matches.get(c, ()) + (key,)
+                    matches[c] = tuple(sorted(keys, key=operator.itemgetter(1)))
+        self._values[key] = value
+
+    def _makeNodeAt(self, value, depth):
+        """
+        Return the node of the given depth on the path of the given value,
+        creating it and splitting compressed chains as needed.
+        """
+        stride = self.stride
+        node = self._root
+        while node[0] != depth:
+            chunk = self._chunk(value, node[0])
+            child = node[3].get(chunk)
+            if child is None:
+                child = self._newNode(value, node[0], depth)
+                node[3][chunk] = child
+                return child
+            # find where, if anywhere, the value leaves the skipped chunks or
+            # the path reaches the target depth among them
+            split = None
+            for d in xrange(node[0] + 1, child[0]):
+                if d == depth or self._chunk(value, d) != \
+                        (child[1] >> ((child[0] - 1 - d)*stride)) & \
+                        ((1 << stride) - 1):
+                    split = d
+                    break
+            if split is not None:
+                middle = self._newNode(value, node[0], split)
+                middle[3][self._chunk(child[1] << \
+                        ((self.width//stride - child[0])*stride), split)] = child
+                child[2] = (1 << ((child[0] - split - 1)*stride)) - 1
+                child[1] &= child[2]
+                node[3][chunk] = middle
+                child = middle
+            node = child
+        return node
+
+    def _newNode(self, value, parent_depth, depth):
+        skip_bits = (depth - parent_depth - 1)*self.stride
+        skip_mask = (1 << skip_bits) - 1
+        skip = (value >> (self.width - depth*self.stride)) & skip_mask
+        return [depth, skip, skip_mask, {}, {}]
+
+    def __delitem__(self, key):
+        if key not in self._values:
+            raise KeyError(key)
+        del self._values[key]
+        if key[1] == 0:
+            self._default = None
+            return
+        depth, chunk = self._checkKey(key)
+
+        # (parent, chunk) pairs along the path to the key's node
+        path = []
+        node = self._root
+        while node[0] != depth:
+            c = self._chunk(key[0], node[0])
+            path.append((node, c))
+            node = node[3][c]
+        matches = node[4]
+        for c in self._covered(key, depth, chunk):
+            keys = tuple(k for k in matches[c] if k != key)
+            if keys:
+                matches[c] = keys
+            else:
+                del matches[c]
+
+        # prune nodes left without keys, and recompress chains
+        while path and not node[4]:
+            parent, c = path.pop()
+            if not node[3]:
+                del parent[3][c]
+                node = parent
+                continue
+            if len(node[3]) == 1:
+                (child_chunk, child), = node[3].items()
+                gap = child[0] - parent[0] - 1
+                child[1] = (((node[1] << self.stride) | child_chunk) << \
+                        ((child[0] - node[0] - 1)*self.stride)) | child[1]
+                child[2] = (1 << (gap*self.stride)) - 1
+                parent[3][c] = child
+            break
+
+    def longest_match(self, x):
+        """
+        Return the longest key that is a prefix of the bits of the integer x.
+        Raise a KeyError if there is none.
+        """
+        width, stride = self.width, self.stride
+        mask = (1 << stride) - 1
+        best = self._default
+        node = self._root
+        while True:
+            shift = width - (node[0]+1)*stride
+            chunk = (x >> shift) & mask
+            keys = node[4].get(chunk)
+            if keys is not None:
+                best = keys[-1]
+            node = node[3].get(chunk)
+            if node is None or (node[2] and (x >> (width - node[0]*stride)) &
+                    node[2] != node[1]):
+                break
+        if best is None:
+            raise KeyError('No key is a prefix of %r.' % x)
+        return best
+
+    def all_matches(self, x):
+        """
+        Generate the keys that are prefixes of the bits of the integer x, from
+        shortest to longest.
+        """
+        width, stride = self.width, self.stride
+        mask = (1 << stride) - 1
+        if self._default is not None:
+            yield self._default
+        node = self._root
+        while True:
+            chunk = (x >> (width - (node[0]+1)*stride)) & mask
+            for key in node[4].get(chunk, ()):
+                yield key
+            node = node[3].get(chunk)
+            if node is None or (node[2] and (x >> (width - node[0]*stride)) &
+                    node[2] != node[1]):
+                break
+
+#===============================================================================
+
+# file layout of a PackedTrieSet: a header, then the nodes in postorder (so
+# every node follows its children), then the pickled null element.
+_PACKED_MAGIC = 'MYTRIE\x00\x01'
+# root offset, number of keys, offset of the null element, symbols-are-chars
+_PACKED_HEADER = struct.Struct('<8sQQQB')
+# is_member, number of children; followed by that many '<Q' child offsets, a
+# '<I' length and the children's symbols (a str of chars, or a pickled tuple)
+_PACKED_NODE = struct.Struct('<BI')
+_PACKED_BLOB_LEN = struct.Struct('<I')
+
+class _PackedChildren(object):
+    """
+    Read-only mapping from symbols to child nodes of a `_PackedNode`,
+    providing the parts of the dict interface that TrieBase uses.
+    """
+    __slots__ = ('_node',)
+
+    def __init__(self, node):
+        self._node = node
+
+    def _index(self, el):
+        symbols = self._node._symbols
+        if self._node._trie._charSymbols:
+            return symbols.find(el)
+        i = bisect.bisect_left(symbols, el)
+        if i < len(symbols) and symbols[i] == el:
+            return i
+        return -1
+
+    def __getitem__(self, el):
+        i = self._index(el)
+        if i < 0:
+            raise KeyError(el)
+        node = self._node
+        return _PackedNode(node._trie, node._offsets[i])
+
+    def get(self, el, default=None):
+        try:
+            return self[el]
+        except KeyError:
+            return default
+
+    def __contains__(self, el):
+        return self._index(el) >= 0
+
+    def __len__(self):
+        return len(self._node._offsets)
+
+    def iterkeys(self):
+        return iter(self._node._symbols)
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        trie = self._node._trie
+        for offset in self._node._offsets:
+            yield _PackedNode(trie, offset)
+
+    def iteritems(self):
+        trie = self._node._trie
+        return ((el, _PackedNode(trie, offset)) for el, offset in
+                zip(self._node._symbols, self._node._offsets))
+
+class _PackedNode(object):
+    """
+    A node of a PackedTrieSet, decoded from its file and standing in for the
+    `[children, is_member]` lists of the other tries.
+    """
+    __slots__ = ('_trie', '_offset', '_member', '_offsets', '_symbols')
+
+    def __init__(self, trie, offset):
+        self._trie = trie
+        self._offset = offset
+        data = trie._data
+        member, n = _PACKED_NODE.unpack_from(data, offset)
+        pos = offset + _PACKED_NODE.size
+        self._offsets = struct.unpack_from('<%dQ' % n, data, pos)
+        pos += 8 * n
+        (blob_len,) = _PACKED_BLOB_LEN.unpack_from(data, pos)
+        pos += _PACKED_BLOB_LEN.size
+        blob = data[pos:pos+blob_len]
+        self._symbols = blob if trie._charSymbols else cPickle.loads(blob)
+        self._member = bool(member)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            # no extra node data
+            return []
+        if i == 0:
+            return _PackedChildren(self)
+        if i == 1:
+            return self._member
+        raise IndexError(i)
+
+class PackedTrieSet(TrieBase):
+    """
+    A read-only TrieSet stored in a compact file, which is memory-mapped
+    rather than loaded, so that it can be far larger than RAM. Supports the
+    query methods of `TrieBase` (`__contains__`, `prefixes`, `maximal_prefix`,
+    `successors`, `extensions`, etc.) with the same semantics as `TrieSet`.
+
+    path is the name of a file written by `PackedTrieSet.build`.
+
+    Each node is decoded from the file as the query reaches it, so queries are
+    several times slower than on a TrieSet, and the symbols of a node are
+    looked up by binary search (or `str.find` for character symbols) rather
+    than hashing.
+
+    >>> import os, tempfile
+    >>> fd, path = tempfile.mkstemp()
+    >>> os.close(fd)
+    >>> t = PackedTrieSet.build(['abc', 'aac', 'adc', 'adce', 'abc'], path,
+    ...     run_bytes=100)
+    >>> len(t)
+    4
+
+    >>> 'abc' in t, 'ab' in t, '' in t, 'xyz' in t
+    (True, False, False, False)
+
+    >>> sorted(t)
+    ['aac', 'abc', 'adc', 'adce']
+
+    >>> sorted(t.extensions('ad'))
+    ['adc', 'adce']
+
+    >>> sorted(t.successors('a'))
+    ['aa', 'ab', 'ad']
+
+    >>> sorted(t.prefixes('adcefgh'))
+    ['adc', 'adce']
+
+    >>> t.maximal_prefix('adcefgh')
+    'adce'
+
+    >>> TrieSet(t) == TrieSet(['abc', 'aac', 'adc', 'adce'])
+    True
+
+    >>> t.close()
+    >>> t = PackedTrieSet(path)
+    >>> repr(t) == 'PackedTrieSet(%r)' % path
+    True
+
+    >>> t.has_extension_of('ab')
+    True
+
+    StringLike keys:
+    -----------------------
+    >>> keys = [StringLike('to be or not to be'.split()[i:]) for i in range(6)]
+    >>> t = PackedTrieSet.build(keys + keys, path,
+    ...     null_element=StringLike.Empty, run_bytes=300)
+    >>> sorted(t) == sorted(set(keys))
+    True
+
+    >>> t.maximal_prefix(StringLike(['to', 'be', 'or', 'else']))
+    StringLike(('to', 'be'))
+
+    >>> t.maximal_prefix(StringLike(['or', 'else']))
+    Traceback (most recent call last):
+        ...
+    KeyError: "No key is a prefix of StringLike(('or', 'else'))."
+
+    >>> StringLike(['be']) in t, StringLike(['to', 'be']) in t
+    (True, True)
+
+    >>> t.close()
+    >>> keys = ['%x' % (i * 7919) for i in xrange(2000)]
+    >>> t = PackedTrieSet.build(keys, path)
+    >>> stats, expected = t.stats(), TrieSet(keys).stats()
+    >>> stats['nodes'] == expected['nodes'], stats['members']
+    (True, 2000)
+
+    >>> t.close()
+    >>> os.remove(path)
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, root, n_keys, meta, chars = _PACKED_HEADER.unpack_from(data, 0)
+        if magic != _PACKED_MAGIC:
+            data.close()
+            raise ValueError('%r is not a packed trie file.' % (path,))
+        null_element = cPickle.loads(data[meta:])
+
+        super(PackedTrieSet, self).__init__(null_element)
+        self._frozen = True
+        self._path = path
+        self._data = data
+        self._charSymbols = bool(chars)
+        self.__len = n_keys
+        self._root = _PackedNode(self, root)
+
+    def __repr__(self):
+        return 'PackedTrieSet(%r)' % (self._path,)
+
+    def __len__(self):
+        return self.__len
+
+    def __reduce__(self):
+        return (PackedTrieSet, (self._path,))
+
+    def _nodeIdentity(self, node):
+        # nodes are decoded anew on each visit, and their ids reused
+        return node._offset
+
+    def _emptyLike(self):
+        # shards of a packed trie are ordinary TrieSets
+        return TrieSet(null_element=self._null_element)
+
+    def _copyEntry(self, source, key, node):
+        self.add(key)
+
+    def __copy__(self):
+        return PackedTrieSet(self._path)
+
+    def __deepcopy__(self, memo):
+        return PackedTrieSet(self._path)
+
+    def close(self):
+        """
+        Release the memory mapping of the file. The PackedTrieSet may not be
+        used afterwards.
+        """
+        self._data.close()
+
+    @classmethod
+    def build(cls, keys, path, null_element='', run_bytes=64*2**20,
+            tmpdir=None):
+        """
+        Write the given iterable of string-like keys to a packed trie file at
+        path, and return a PackedTrieSet for it.
+
+        The keys need not be sorted or unique, and are consumed in a single
+        pass. Memory use is bounded by run_bytes (an estimate of the size of
+        the keys held at once, per `sys.getsizeof` of each `str`, or of each
+        `StringLike` and its tokens) plus the longest key: keys are sorted in
+        runs of about run_bytes, each run is spilled to a temporary file in
+        tmpdir, and the runs are merged as a stream into the packed trie, which
+        is written out node by node as soon as each node is complete. No more
+        than `_MAX_MERGE_RUNS` runs are merged at once.
+
+        The keys' sort order must agree with the lexicographic order of their
+        symbols, as it does for `str` and `StringLike`.
+        """
+        if not isStringLike(null_element, null_element):
+            raise TypeError('null_element %r is not itself string-like!' %\
+                    (null_element,))
+
+        runs = []
+        try:
+            run = []
+            size = 0
+            for key in keys:
+                if not isStringLike(key, null_element):
+                    raise TypeError('Key must be string-like with null '\
+                            'element %r! (got %r)' % (null_element, key))
+                run.append(key)
+                size += _keyBytes(key)
+                if size >= run_bytes:
+                    runs.append(_spillRun(run, tmpdir))
+                    run = []
+                    size = 0
+            run.sort()
+
+            while len(runs) > _MAX_MERGE_RUNS:
+                merged = _spillRun(_mergeRuns(runs[:_MAX_MERGE_RUNS]), tmpdir,
+                        presorted=True)
+                for f in runs[:_MAX_MERGE_RUNS]:
+                    f.close()
+                runs[:_MAX_MERGE_RUNS] = [merged]
+
+            with open(path, 'wb') as out:
+                _writePacked(heapq.merge(run, *map(_readRun, runs)), out,
+                        null_element)
+        finally:
+            for f in runs:
+                f.close()
+
+        return cls(path)
+
+# the most spilled runs merged at once by PackedTrieSet.build
+_MAX_MERGE_RUNS = 64
+
+def _keyBytes(key):
+    """
+    Estimate the size in bytes of a key, including the tokens of StringLikes.
+    """
+    if isinstance(key, StringLike):
+        return sys.getsizeof(key) + sys.getsizeof(key.tokens) + \
+                sum(sys.getsizeof(tok) for tok in key.tokens)
+    return sys.getsizeof(key)
+
+def _spillRun(keys, tmpdir, presorted=False):
+    """
+    Write the keys, sorted, to an anonymous temporary file, and return it.
+    """
+    if not presorted:
+        keys.sort()
+    f = tempfile.TemporaryFile(dir=tmpdir)
+    first = True
+    for key in keys:
+        if first or key != prev:
+            cPickle.dump(key, f, cPickle.HIGHEST_PROTOCOL)
+        first = False
+        prev = key
+    f.seek(0)
+    return f
+
+def _readRun(f):
+    load = cPickle.Unpickler(f).load
+    while True:
+        try:
+            yield load()
+        except EOFError:
+            return
+
+def _mergeRuns(runs):
+    return heapq.merge(*map(_readRun, runs))
+
+def _writePacked(sorted_keys, out, null_element):
+    """
+    Write a packed trie of the given sorted keys to the file out, holding only
+    the nodes along the path of the current key in memory.
+    """
+    chars = isinstance(null_element, str)
+    out.write(_PACKED_HEADER.pack(_PACKED_MAGIC, 0, 0, 0, chars))
+    offset = [_PACKED_HEADER.size]
+
+    def writeNode(is_member, children):
+        symbols = [el for el, child in children]
+        if chars:
+            blob = ''.join(symbols)
+        else:
+            blob = cPickle.dumps(tuple(symbols), cPickle.HIGHEST_PROTOCOL)
+        record = _PACKED_NODE.pack(is_member, len(children)) + \
+                struct.pack('<%dQ' % len(children),
+                        *[child for el, child in children]) + \
+                _PACKED_BLOB_LEN.pack(len(blob)) + blob
+        out.write(record)
+        node_offset = offset[0]
+        offset[0] += len(record)
+        return node_offset
+
+    # frames of [symbol, is_member, [(symbol, child offset), ...]] along the
+    # path of the previous key, starting with the root
+    stack = [[None, False, []]]
+    prev = []
+    n_keys = 0
+    for key in sorted_keys:
+        symbols = list(key)
+        common = 0
+        limit = min(len(prev), len(symbols))
+        while common < limit and prev[common] == symbols[common]:
+            common += 1
+        if common == len(symbols) == len(prev) and stack[-1][1]:
+            # duplicate
+            continue
+        while len(stack) > common + 1:
+            el, is_member, children = stack.pop()
+            stack[-1][2].append((el, writeNode(is_member, children)))
+        for el in symbols[common:]:
+            stack.append([el, False, []])
+        stack[-1][1] = True
+        n_keys += 1
+        prev = symbols
+
+    while len(stack) > 1:
+        el, is_member, children = stack.pop()
+        stack[-1][2].append((el, writeNode(is_member, children)))
+    root = writeNode(stack[0][1], stack[0][2])
+
+    meta = offset[0]
+    out.write(cPickle.dumps(null_element, cPickle.HIGHEST_PROTOCOL))
+    out.seek(0)
+    out.write(_PACKED_HEADER.pack(_PACKED_MAGIC, root, n_keys, meta, chars))
+
+#===============================================================================
+
+class _CallCounts(object):
+    __slots__ = ('probes', 'nodes', 'keys')
+
+    def __init__(self):
+        self.probes = self.nodes = self.keys = 0
+
+class _CountingMixin(object):
+    """
+    Overrides the traversal primitives of TrieBase with versions that tally
+    their work into `self._counters`. Mixed into trie classes by
+    `_instrumentedClass`; see `TrieBase.instrument()`.
+    """
+
+    def __contains__(self, key):
+        c = self._counters
+        cur_node = self._root
+        c.nodes += 1
+        for el in key:
+            c.probes += 1
+            try:
+                cur_node = cur_node[0][el]
+            except KeyError:
+                return False
+            c.nodes += 1
+        return cur_node[1]
+
+    def _walk(self, cur_node, key):
+        c = self._counters
+        c.nodes += 1
+        for el in key:
+            c.probes += 1
+            try:
+                cur_node = cur_node[0][el]
+            except KeyError:
+                return None
+            c.nodes += 1
+        return cur_node
+
+    def _nodeOf(self, key):
+        return self._walk(self._root, key)
+
+    def _reverseNodeOf(self, suffix):
+        # let the base class complain if there is no reverse index
+        root = super(_CountingMixin, self)._reverseNodeOf(self._null_element)
+        return self._walk(root, reversed(list(suffix)))
+
+    def _TrieBase__pathTo(self, key):
+        c = self._counters
+        cur_node = self._root
+        for el in key:
+            c.nodes += 1
+            yield cur_node
+            c.probes += 1
+            # let KeyError propagate
+            cur_node = cur_node[0][el]
+        c.nodes += 1
+        yield cur_node
+
+    def _reversePathTo(self, string):
+        c = self._counters
+        cur_node = super(_CountingMixin, self)._reverseNodeOf(
+                self._null_element)
+        c.nodes += 1
+        yield cur_node
+        for el in reversed(list(string)):
+            c.probes += 1
+            try:
+                cur_node = cur_node[0][el]
+            except KeyError:
+                return
+            c.nodes += 1
+            yield cur_node
+
+    def _TrieBase__generateKeys(self, cur_node=None, prefix=None):
+        for node, key in self._generateSubNodes(cur_node or self._root,
+                prefix or self._null_element):
+            if node[1]:
+                yield key
+
+    __iter__ = _TrieBase__generateKeys
+
+    def _generateSubNodes(self, start_node, prefix):
+        self._counters.nodes += 1
+        yield start_node, prefix
+        for el, el_node in start_node[0].iteritems():
+            for node, subel in self._generateSubNodes(el_node, prefix+el):
+                yield node, subel
+
+    def _hammingMatches(self, root, symbols, max_mismatches, head=0,
+            head_mismatches=0):
+        c = self._counters
+        n = len(symbols)
+        stack = [(root, 0, 0, self._null_element)]
+        while stack:
+            node, depth, mismatches, prefix = stack.pop()
+            c.nodes += 1
+            if depth == n:
+                if node[1]:
+                    yield prefix, mismatches
+                continue
+            el = symbols[depth]
+            budget = head_mismatches if depth < head else max_mismatches
+            if mismatches >= budget:
+                c.probes += 1
+                el_node = node[0].get(el)
+                if el_node is not None:
+                    stack.append((el_node, depth+1, mismatches, prefix+el))
+                continue
+            for child_el, el_node in node[0].iteritems():
+                stack.append((el_node, depth+1,
+                    mismatches if child_el == el else mismatches+1,
+                    prefix+child_el))
+
+    def _generateReversedKeys(self, start_node, suffix):
+        c = self._counters
+        stack = [(start_node, suffix)]
+        while stack:
+            cur_node, key = stack.pop()
+            c.nodes += 1
+            if cur_node[1]:
+                yield key
+            for el, el_node in cur_node[0].iteritems():
+                stack.append((el_node, el+key))
+
+def _countedCall(name, method, count_keys):
+    def counted(self, *args, **kwargs):
+        if self._counters is not self._idleCounters:
+            # nested inside another counted call
+            return method(self, *args, **kwargs)
+        rec = self._counters = _CallCounts()
+        try:
+            result = method(self, *args, **kwargs)
+            if count_keys is not None:
+                rec.keys += count_keys(result)
+            return result
+        finally:
+            self._counters = self._idleCounters
+            self._reportCall(name, rec)
+    counted.__name__ = name
+    counted.__doc__ = method.__doc__
+    return counted
+
+def _countedGenerator(name, method):
+    def counted(self, *args, **kwargs):
+        if self._counters is not self._idleCounters:
+            for item in method(self, *args, **kwargs):
+                yield item
+            return
+        rec = _CallCounts()
+        gen = method(self, *args, **kwargs)
+        try:
+            while True:
+                # only attribute work to this call while it is running, since
+                # generators may be interleaved with other calls
+                prev, self._counters = self._counters, rec
+                try:
+                    item = gen.next()
+                except StopIteration:
+                    return
+                finally:
+                    self._counters = prev
+                rec.keys += 1
+                yield item
+        finally:
+            self._reportCall(name, rec)
+    counted.__name__ = name
+    counted.__doc__ = method.__doc__
+    return counted
+
+def _reportCall(self, name, rec):
+    counts = {'probes': rec.probes, 'nodes': rec.nodes, 'keys': rec.keys}
+    try:
+        totals = self._callTotals[name]
+    except KeyError:
+        totals = self._callTotals[name] = {'calls': 0, 'probes': 0,
+                'nodes': 0, 'keys': 0}
+    totals['calls'] += 1
+    for k, v in counts.iteritems():
+        totals[k] += v
+    if self._hook is not None:
+        self._hook(name, counts)
+
+_INSTRUMENTED_CLASSES = {}
+
+def _instrumentedClass(cls):
+    """
+    Return (creating and caching if necessary) a subclass of the given trie
+    class whose public query methods count their work.
+    """
+    try:
+        return _INSTRUMENTED_CLASSES[cls]
+    except KeyError:
+        pass
+
+    counting = type(cls.__name__, (_CountingMixin, cls), {
+        '__module__': cls.__module__,
+        '_uninstrumentedClass': cls,
+        '_reportCall': _reportCall,
+    })
+    for name in cls._instrumentedMethods:
+        method = getattr(counting, name, None)
+        if method is None:
+            continue
+        func = method.im_func
+        if func.func_code.co_flags & 0x20: # CO_GENERATOR
+            counted = _countedGenerator(name, func)
+        elif name in cls._keyReturningMethods:
+            counted = _countedCall(name, func, lambda result: 1)
+        elif name in cls._keyListReturningMethods:
+            counted = _countedCall(name, func, len)
+        else:
+            counted = _countedCall(name, func, None)
+        setattr(counting, name, counted)
+
+    _INSTRUMENTED_CLASSES[cls] = counting
+    return counting
+
 #===============================================================================
 
 # Modified slightly for efficiency by Max Bane, 2011 -- python implementation of